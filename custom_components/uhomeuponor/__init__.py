@@ -6,16 +6,23 @@ https://github.com/fcastroruiz/uhomeuponor
 from logging import getLogger
 import asyncio
 from datetime import timedelta
-from homeassistant.core import HomeAssistant
-from homeassistant.const import Platform, CONF_HOST
+import voluptuous as vol
+from homeassistant.core import HomeAssistant, ServiceCall, Event
+from homeassistant.const import Platform, CONF_HOST, CONF_PREFIX, EVENT_HOMEASSISTANT_CLOSE, EVENT_HOMEASSISTANT_STOP
 from homeassistant.config_entries import ConfigEntry, ConfigEntryState
-from homeassistant.exceptions import ConfigEntryNotReady
+from homeassistant.exceptions import ConfigEntryNotReady, HomeAssistantError
+from homeassistant.components.climate import ATTR_HVAC_MODE, ATTR_PRESET_MODE, HVACMode, PRESET_AWAY, PRESET_COMFORT, PRESET_ECO
 from homeassistant.helpers import device_registry, entity_registry
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
 import homeassistant.util.dt as dt_util
 import homeassistant.helpers.config_validation as cv
-from .uponor_api.const import DOMAIN
-from .uponor_api import UponorClient
+from .uponor_api.const import DOMAIN, UHOME_MODE_HEAT, UHOME_MODE_COOL, UHOME_MODE_ECO, UHOME_MODE_COMFORT
+from .uponor_api import UponorClient, UponorAPIException, UponorDeadlineException
+from .uponor_api.utilities import Deadline
+from .uponor_api.profiler import TUNING_FILE, load_tuning
+from .climate import CONF_SUPPORTS_HEATING, CONF_SUPPORTS_COOLING
 
 _LOGGER = getLogger(__name__)
 
@@ -24,50 +31,147 @@ PLATFORMS = [Platform.SENSOR, Platform.CLIMATE]
 # If the integration does not support YAML configuration, declare this
 CONFIG_SCHEMA = cv.config_entry_only_config_schema(DOMAIN)
 
+# Watchdog: after UNAVAILABLE_THRESHOLD without a successful request the session is reconnected and the
+# topology re-validated in place, at most every RECONNECT_COOLDOWN. Only a changed topology reloads the entry
+# Entities do not poll, one timer polls the devices that are due and the client notifies the entities
+POLL_INTERVAL = timedelta(seconds=10)
+WATCHDOG_INTERVAL = timedelta(seconds=30)
 UNAVAILABLE_THRESHOLD = timedelta(minutes=2)
+RECONNECT_COOLDOWN = timedelta(minutes=2)
 RELOAD_COOLDOWN = timedelta(minutes=10)
+# Budget of the initial rescan: module + N controllers + M thermostats requests
+SETUP_TIMEOUT_SECONDS = 60
+
+# Snapshot of all register values, saved periodically and on stop. Setup restores it instead of waiting for a
+# rescan, and refreshes the restored values in the background
+SNAPSHOT_STORAGE_VERSION = 1
+SNAPSHOT_INTERVAL = timedelta(minutes=10)
+SNAPSHOT_MAX_AGE = timedelta(hours=24)
+
+SERVICE_SET_SETPOINTS = "set_setpoints"
+ATTR_SETPOINTS = "setpoints"
+
+SET_SETPOINTS_SCHEMA = vol.Schema({
+    # Climate entity id or room name -> setpoint
+    vol.Required(ATTR_SETPOINTS): {cv.string: vol.All(vol.Coerce(float), vol.Range(min=5, max=35))},
+    vol.Optional(ATTR_HVAC_MODE): vol.In([HVACMode.HEAT, HVACMode.COOL]),
+    vol.Optional(ATTR_PRESET_MODE): vol.In([PRESET_COMFORT, PRESET_AWAY, PRESET_ECO]),
+})
 
 async def async_setup(hass: HomeAssistant, config: dict):
     """Set up this integration using UI."""
     hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN]["config"] = config.get(DOMAIN) or {}
+
+    async def async_set_setpoints(call: ServiceCall):
+        await async_handle_set_setpoints(hass, call)
+
+    hass.services.async_register(DOMAIN, SERVICE_SET_SETPOINTS, async_set_setpoints, schema=SET_SETPOINTS_SCHEMA)
     return True
 
+def _find_climate_entity(entry_data, room):
+    """Finds the climate entity of a room, by entity id or room name"""
+    for entity in entry_data.get("climate_entities", []):
+        if entity.entity_id == room or str(entity.thermostat.by_name('room_name').value).lower() == room.lower():
+            return entity
+    return None
+
+async def async_handle_set_setpoints(hass: HomeAssistant, call: ServiceCall):
+    """Writes the setpoints of several rooms, and optionally the modes, with a single request per gateway"""
+    entries = [entry_data for key, entry_data in hass.data[DOMAIN].items() if key != "config"]
+    if len(entries) == 0:
+        raise HomeAssistantError("Uhome Uponor is not loaded")
+
+    hc_mode = None
+    if ATTR_HVAC_MODE in call.data:
+        hc_mode = UHOME_MODE_COOL if call.data[ATTR_HVAC_MODE] == HVACMode.COOL else UHOME_MODE_HEAT
+
+    forced_eco_mode = None
+    if ATTR_PRESET_MODE in call.data:
+        forced_eco_mode = UHOME_MODE_COMFORT if call.data[ATTR_PRESET_MODE] == PRESET_COMFORT else UHOME_MODE_ECO
+
+    # Resolve every room before writing anything
+    writes = []
+    unknown = set(call.data[ATTR_SETPOINTS])
+    for entry_data in entries:
+        setpoints = {}
+        for room, temperature in call.data[ATTR_SETPOINTS].items():
+            entity = _find_climate_entity(entry_data, room)
+            if entity is not None:
+                setpoints[entity] = temperature
+                unknown.discard(room)
+        writes.append((entry_data["client"], setpoints))
+
+    if unknown:
+        raise HomeAssistantError(f"Unknown Uponor rooms: {', '.join(sorted(unknown))}")
+
+    for client, setpoints in writes:
+        if len(setpoints) == 0 and hc_mode is None and forced_eco_mode is None:
+            continue
+        try:
+            await client.set_setpoints({entity.thermostat: temperature for entity, temperature in setpoints.items()},
+                                       hc_mode, forced_eco_mode)
+        except UponorAPIException as ex:
+            raise HomeAssistantError(str(ex)) from ex
+        # The write notifies the subscribed climate entities, disabled ones are matched by name too but have no state
+
 async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry):
     """Set up this integration using UI."""
     _LOGGER.info("Loading setup entry")
 
-    if config_entry.options:
-        if config_entry.data != config_entry.options:
-            dev_reg = device_registry.async_get(hass)
-            ent_reg = entity_registry.async_get(hass)
-            dev_reg.async_clear_config_entry(config_entry.entry_id)
-            ent_reg.async_clear_config_entry(config_entry.entry_id)
-            hass.config_entries.async_update_entry(config_entry, data=config_entry.options)
+    if config_entry.options and config_entry.data != config_entry.options:
+        _async_apply_options(hass, config_entry)
 
     host = config_entry.data[CONF_HOST]
-    session = async_get_clientsession(hass)
+    # A session of our own, the watchdog replaces it to drop stale connections to the gateway
+    session = async_create_clientsession(hass, auto_cleanup=False)
 
     uponor = UponorClient(hass=hass, server=host, session=session)
-    try:
-        # timeout=60: full rescan does module + N controllers + M thermostats requests
-        # Each aiohttp request has total=10s timeout, so with 2 controllers and
-        # 12 thermostats in batches this can take 15-30s. 8s was too short.
-        await asyncio.wait_for(uponor.rescan(), timeout=60.0)
-    except asyncio.CancelledError:
-        raise
-    except (asyncio.TimeoutError, TimeoutError) as err:
-        _LOGGER.warning("Timeout connecting to Uponor gateway at %s, will retry", host)
-        raise ConfigEntryNotReady(f"Timeout connecting to Uponor gateway at {host}") from err
-    except Exception as err:
-        _LOGGER.warning("Failed to connect to Uponor gateway at %s: %s, will retry", host, err)
-        raise ConfigEntryNotReady(f"Cannot connect to Uponor gateway at {host}: {err}") from err
+
+    # Settings recommended by the tune command of the command line client
+    tuning = await hass.async_add_executor_job(load_tuning, hass.config.path(TUNING_FILE))
+    if tuning is not None and tuning.get("host") in (None, host):
+        try:
+            uponor.apply_tuning(tuning)
+            _LOGGER.info("Applied tuning from %s: %s", TUNING_FILE, {key: value for key, value in tuning.items() if key != "measured"})
+        except (TypeError, ValueError) as ex:
+            _LOGGER.warning("Ignoring invalid tuning in %s: %s", TUNING_FILE, ex)
+
+    # Last-known values, shown as restored until the first update
+    snapshot_store = Store(hass, SNAPSHOT_STORAGE_VERSION, f"{DOMAIN}.{config_entry.entry_id}.snapshot")
+    snapshot = await snapshot_store.async_load()
+    restored = snapshot is not None and snapshot.get("host") == host and \
+        uponor.restore(snapshot.get("client"), max_age=SNAPSHOT_MAX_AGE)
+    if restored:
+        _LOGGER.info("Restored %d thermostats of Uponor gateway at %s from snapshot", len(uponor.thermostats), host)
+
+    if not restored:
+        try:
+            # Every request of the rescan shrinks its timeout and retries to the remaining budget.
+            # With 2 controllers and 12 thermostats in batches a rescan can take 15-30s, 8s was too short.
+            await uponor.rescan(deadline=Deadline(SETUP_TIMEOUT_SECONDS))
+        except asyncio.CancelledError:
+            await session.close()
+            raise
+        except (asyncio.TimeoutError, TimeoutError, UponorDeadlineException) as err:
+            await session.close()
+            _LOGGER.warning("Timeout connecting to Uponor gateway at %s, will retry", host)
+            raise ConfigEntryNotReady(f"Timeout connecting to Uponor gateway at {host}") from err
+        except Exception as err:
+            await session.close()
+            _LOGGER.warning("Failed to connect to Uponor gateway at %s: %s, will retry", host, err)
+            raise ConfigEntryNotReady(f"Cannot connect to Uponor gateway at {host}: {err}") from err
 
     hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN][config_entry.entry_id] = {
         "client": uponor,
+        "snapshot_store": snapshot_store,
+        # Entities of all platforms, for option changes applied in place
+        "entities": [],
         "last_successful_update": dt_util.now(),
         "unavailable_since": None,
+        "reconnect_in_progress": False,
+        "last_reconnect_attempt": None,
         "reload_in_progress": False,
         "last_reload_attempt": None,
     }
@@ -75,21 +179,201 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry):
     await hass.config_entries.async_forward_entry_setups(config_entry, PLATFORMS)
 
     config_entry.async_on_unload(config_entry.add_update_listener(async_update_options))
+
+    async def async_poll(now):
+        try:
+            await uponor.poll()
+        except UponorAPIException as ex:
+            # Entities are notified of the failure, the watchdog handles long outages
+            _LOGGER.debug("Uponor poll failed: %s", ex)
+
+    config_entry.async_on_unload(async_track_time_interval(hass, async_poll, POLL_INTERVAL))
+
+    async def async_watchdog(now):
+        await async_check_connection(hass, config_entry)
+
+    config_entry.async_on_unload(async_track_time_interval(hass, async_watchdog, WATCHDOG_INTERVAL))
+
+    async def async_close_session(event: Event):
+        await uponor.session.close()
+
+    config_entry.async_on_unload(hass.bus.async_listen_once(EVENT_HOMEASSISTANT_CLOSE, async_close_session))
+
+    async def async_save_snapshot_now(now_or_event):
+        await async_save_snapshot(hass, config_entry)
+
+    config_entry.async_on_unload(async_track_time_interval(hass, async_save_snapshot_now, SNAPSHOT_INTERVAL))
+    config_entry.async_on_unload(hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_save_snapshot_now))
+
+    if restored:
+        hass.async_create_task(async_refresh_restored(hass, config_entry))
     
     return True
 
+async def async_save_snapshot(hass: HomeAssistant, config_entry: ConfigEntry):
+    """Saves the current register values, restored on the next setup"""
+    entry_data = hass.data[DOMAIN].get(config_entry.entry_id)
+    if entry_data is None:
+        return
+    snapshot = entry_data["client"].snapshot()
+    if snapshot is None:
+        return
+    await entry_data["snapshot_store"].async_save({"host": entry_data["client"].server, "client": snapshot})
+
+async def async_refresh_restored(hass: HomeAssistant, config_entry: ConfigEntry):
+    """Replaces restored values with fresh ones, reloading when the topology changed since the snapshot"""
+    entry_data = hass.data[DOMAIN].get(config_entry.entry_id)
+    if entry_data is None:
+        return
+
+    uponor = entry_data["client"]
+    entry_data["reconnect_in_progress"] = True
+    try:
+        unchanged = await uponor.revalidate(deadline=Deadline(SETUP_TIMEOUT_SECONDS))
+    except UponorAPIException as ex:
+        # Entities keep the restored values, the watchdog retries
+        _LOGGER.warning("Failed to refresh restored values from Uponor gateway at %s: %s", uponor.server, ex)
+        return
+    finally:
+        entry_data["reconnect_in_progress"] = False
+
+    if not unchanged:
+        _LOGGER.warning("Uponor gateway at %s reports a different topology than the snapshot, reloading", uponor.server)
+        entry_data["reload_in_progress"] = True
+        entry_data["last_reload_attempt"] = dt_util.now()
+        hass.async_create_task(hass.config_entries.async_reload(config_entry.entry_id))
+        return
+
+    entry_data["last_successful_update"] = dt_util.now()
+    for entity in entry_data["entities"]:
+        if entity.hass is not None:
+            entity.async_write_ha_state()
+
+async def async_check_connection(hass: HomeAssistant, config_entry: ConfigEntry):
+    """Watchdog: recovers from long gateway outages in place, without reloading the entry and its entities"""
+    entry_data = hass.data[DOMAIN].get(config_entry.entry_id)
+    if entry_data is None or entry_data["reconnect_in_progress"] or entry_data["reload_in_progress"]:
+        return
+
+    uponor = entry_data["client"]
+    now = dt_util.now()
+    since_success = uponor.time_since_success()
+    if since_success is not None and since_success < UNAVAILABLE_THRESHOLD:
+        entry_data["last_successful_update"] = now - since_success
+        if entry_data["unavailable_since"] is None:
+            return
+    elif entry_data["unavailable_since"] is None:
+        entry_data["unavailable_since"] = entry_data["last_successful_update"]
+        _LOGGER.warning("No response from Uponor gateway at %s since %s", uponor.server, entry_data["unavailable_since"])
+
+    # After an outage, polls may already succeed again, the topology is still re-validated once
+    last_attempt = entry_data["last_reconnect_attempt"]
+    if last_attempt is not None and now - last_attempt < RECONNECT_COOLDOWN:
+        return
+
+    entry_data["reconnect_in_progress"] = True
+    entry_data["last_reconnect_attempt"] = now
+    try:
+        # Drop connections the gateway may have forgotten, e.g. after a reboot
+        old_session = uponor.session
+        uponor.session = async_create_clientsession(hass, auto_cleanup=False)
+        await old_session.close()
+
+        unchanged = await uponor.revalidate(deadline=Deadline(SETUP_TIMEOUT_SECONDS))
+    except UponorAPIException as ex:
+        _LOGGER.debug("Reconnecting to Uponor gateway at %s failed: %s", uponor.server, ex)
+        return
+    finally:
+        entry_data["reconnect_in_progress"] = False
+
+    if unchanged:
+        _LOGGER.info("Reconnected to Uponor gateway at %s, unavailable since %s", uponor.server, entry_data["unavailable_since"])
+        entry_data["unavailable_since"] = None
+        entry_data["last_successful_update"] = dt_util.now()
+        return
+
+    # Controllers or thermostats were added or removed, entities must be recreated
+    last_reload = entry_data["last_reload_attempt"]
+    if last_reload is not None and now - last_reload < RELOAD_COOLDOWN:
+        return
+    _LOGGER.warning("Uponor gateway at %s reports a changed topology, reloading", uponor.server)
+    entry_data["reload_in_progress"] = True
+    entry_data["last_reload_attempt"] = now
+    hass.async_create_task(hass.config_entries.async_reload(config_entry.entry_id))
+
+def _async_apply_options(hass: HomeAssistant, entry: ConfigEntry):
+    """Makes the options the entry data, renaming the registry entries of the entry when the prefix changed"""
+    old_prefix = entry.data.get(CONF_PREFIX) or ""
+    new_prefix = entry.options.get(CONF_PREFIX) or ""
+    if old_prefix != new_prefix:
+        _async_rename_prefix(hass, entry, old_prefix, new_prefix)
+
+    hass.config_entries.async_update_entry(entry, data=entry.options)
+
+def _replace_prefix(value, old_prefix, new_prefix):
+    if value is None or not value.startswith(old_prefix):
+        return value
+    return new_prefix + value[len(old_prefix):]
+
+def _async_rename_prefix(hass: HomeAssistant, entry: ConfigEntry, old_prefix, new_prefix):
+    """Renames unique ids, device identifiers and device names from one prefix to another, keeping entity ids and history"""
+    ent_reg = entity_registry.async_get(hass)
+    for registry_entry in entity_registry.async_entries_for_config_entry(ent_reg, entry.entry_id):
+        unique_id = _replace_prefix(registry_entry.unique_id, old_prefix, new_prefix)
+        if unique_id == registry_entry.unique_id:
+            continue
+        try:
+            ent_reg.async_update_entity(registry_entry.entity_id, new_unique_id=unique_id)
+        except ValueError as ex:
+            _LOGGER.warning("Could not rename %s to %s: %s", registry_entry.entity_id, unique_id, ex)
+
+    dev_reg = device_registry.async_get(hass)
+    for device in device_registry.async_entries_for_config_entry(dev_reg, entry.entry_id):
+        identifiers = {(domain, _replace_prefix(id, old_prefix, new_prefix) if domain == DOMAIN else id)
+                       for domain, id in device.identifiers}
+        dev_reg.async_update_device(device.id, new_identifiers=identifiers,
+                                    name=_replace_prefix(device.name, old_prefix, new_prefix))
+
 async def async_update_options(hass: HomeAssistant, entry: ConfigEntry) -> None:
-    """Update options."""
+    """Update options. Prefix and heating/cooling changes are applied to the loaded entities, a host change reloads"""
     _LOGGER.debug("Update setup entry: %s, data: %s, options: %s", entry.entry_id, entry.data, entry.options)
-    # Unload first to ensure clean state (if loaded), then reload
-    if entry.state in (ConfigEntryState.LOADED, ConfigEntryState.SETUP_RETRY):
-        await hass.config_entries.async_unload(entry.entry_id)
-    await hass.config_entries.async_reload(entry.entry_id)
+    if not entry.options or entry.data == entry.options:
+        return
+
+    entry_data = hass.data[DOMAIN].get(entry.entry_id)
+    if entry_data is None or entry.state != ConfigEntryState.LOADED or entry.data.get(CONF_HOST) != entry.options.get(CONF_HOST):
+        # async_setup_entry applies the options
+        # Unload first to ensure clean state (if loaded), then reload
+        if entry.state in (ConfigEntryState.LOADED, ConfigEntryState.SETUP_RETRY):
+            await hass.config_entries.async_unload(entry.entry_id)
+        await hass.config_entries.async_reload(entry.entry_id)
+        return
+
+    old_prefix = entry.data.get(CONF_PREFIX) or ""
+    new_prefix = entry.options.get(CONF_PREFIX) or ""
+    _async_apply_options(hass, entry)
+
+    for entity in entry_data["entities"]:
+        if old_prefix != new_prefix:
+            entity.prefix = new_prefix
+            entity.device_name = _replace_prefix(entity.device_name, old_prefix, new_prefix)
+            entity.device_id = _replace_prefix(entity.device_id, old_prefix, new_prefix)
+            entity.identity = _replace_prefix(entity.identity, old_prefix, new_prefix)
+        if hasattr(entity, 'supports_heating'):
+            entity.supports_heating = entry.data.get(CONF_SUPPORTS_HEATING, True)
+            entity.supports_cooling = entry.data.get(CONF_SUPPORTS_COOLING, True)
+        # Entities disabled in the registry were never added
+        if entity.hass is not None:
+            entity.async_write_ha_state()
 
 async def async_unload_entry(hass: HomeAssistant, config_entry: ConfigEntry) -> bool:
     """Unload a config entry."""
     _LOGGER.debug("Unloading setup entry: %s, data: %s, options: %s", config_entry.entry_id, config_entry.data, config_entry.options)
     unload_ok = await hass.config_entries.async_unload_platforms(config_entry, PLATFORMS)
     if unload_ok:
+        entry_data = hass.data[DOMAIN].get(config_entry.entry_id)
+        if entry_data is not None:
+            await async_save_snapshot(hass, config_entry)
+            await entry_data["client"].session.close()
         hass.data[DOMAIN].pop(config_entry.entry_id, None)
     return unload_ok
@@ -8,9 +8,12 @@ from homeassistant.components.climate import ClimateEntity
 from homeassistant.components.climate.const import (
     HVACMode, PRESET_COMFORT, PRESET_ECO, PRESET_AWAY, HVACAction, ClimateEntityFeature)
 from homeassistant.const import (ATTR_TEMPERATURE, CONF_PREFIX, PRECISION_TENTHS, UnitOfTemperature)
+from homeassistant.core import callback
+from homeassistant.exceptions import HomeAssistantError
 from logging import getLogger
 
-from .uponor_api.const import (DOMAIN, UHOME_MODE_HEAT, UHOME_MODE_COOL, UHOME_MODE_ECO, UHOME_MODE_COMFORT)
+from .uponor_api import UponorAPIException
+from .uponor_api.const import (ATTR_RESTORED, DOMAIN, UHOME_MODE_HEAT, UHOME_MODE_COOL, UHOME_MODE_ECO, UHOME_MODE_COMFORT)
 
 CONF_SUPPORTS_HEATING = "supports_heating"
 CONF_SUPPORTS_COOLING = "supports_cooling"
@@ -32,8 +35,14 @@ async def async_setup_entry(hass, config_entry, async_add_entities):
 
     uponor = hass.data[DOMAIN][config_entry.entry_id]["client"]
 
-    async_add_entities([UponorThermostat(prefix, uponor, thermostat, supports_heating, supports_cooling)
-                  for thermostat in uponor.thermostats], True)
+    entities = [UponorThermostat(prefix, uponor, thermostat, supports_heating, supports_cooling)
+                for thermostat in uponor.thermostats]
+    # Used by the set_setpoints service to resolve entity ids
+    hass.data[DOMAIN][config_entry.entry_id]["climate_entities"] = entities
+    hass.data[DOMAIN][config_entry.entry_id]["entities"].extend(entities)
+
+    # Entities start from the values read by rescan, the first updates come with the regular polls
+    async_add_entities(entities)
     
     _LOGGER.info("finish setup climate platform for Uhome Uponor")
     return True
@@ -42,7 +51,9 @@ class UponorThermostat(ClimateEntity):
     """HA Thermostat climate entity. Utilizes Uponor U@Home API to interact with U@Home"""
 
     def __init__(self, prefix, uponor_client, thermostat, supports_heating, supports_cooling):
-        self._available = False
+        # Seeded from the values read by rescan. Properties read the ThermostatState of one update, taken when writing the state
+        self._state = thermostat.state
+        self._available = self._state.valid
         self.prefix = prefix
         self.uponor_client = uponor_client
         self.thermostat = thermostat
@@ -71,7 +82,10 @@ class UponorThermostat(ClimateEntity):
 
     @property
     def available(self):
-        return self._available
+        # Invalid values, or values past their hard TTL, are unavailable. Restored values until the first update.
+        # Staleness is checked against the latest state, _state is only replaced when values change
+        state = self.thermostat.state
+        return self._available and (state.restored or not state.is_stale())
 
     # ** Static **
     @property
@@ -109,61 +123,72 @@ class UponorThermostat(ClimateEntity):
     # ** State **
     @property
     def current_humidity(self):
-        return self.thermostat.by_name('rh_value').value
+        return self._state.rh_value
 
     @property
     def current_temperature(self):
-        return self.thermostat.by_name('room_temperature').value
+        return self._state.room_temperature
 
     @property
     def target_temperature(self):
-        return self.thermostat.by_name('room_setpoint').value
+        return self._state.room_setpoint
     
     @property
     def extra_state_attributes(self):
-        return {
-            ATTR_TECHNICAL_ALARM: self.thermostat.by_name(ATTR_TECHNICAL_ALARM).value,
-            ATTR_RF_SIGNAL_ALARM: self.thermostat.by_name(ATTR_RF_SIGNAL_ALARM).value,
-            ATTR_BATTERY_ALARM: self.thermostat.by_name(ATTR_BATTERY_ALARM).value,
-            ATTR_REMOTE_ACCESS_ALARM: self.uponor_client.uhome.by_name(ATTR_REMOTE_ACCESS_ALARM).value,
-            ATTR_DEVICE_LOST_ALARM: self.uponor_client.uhome.by_name(ATTR_DEVICE_LOST_ALARM).value
-        }
+        # technical_alarm, rf_alarm, battery_alarm, remote_access_alarm and device_lost_alarm
+        attributes = dict(self._state.alarms)
+        # Last-known values from before a restart, until the first update
+        if self._state.restored:
+            attributes[ATTR_RESTORED] = True
+        return attributes
         
     @property
     def preset_mode(self):
-        if self.uponor_client.uhome.by_name('forced_eco_mode').value == 1:
-            return PRESET_AWAY
-
-        return PRESET_COMFORT
+        return PRESET_AWAY if self._state.forced_eco else PRESET_COMFORT
 
     @property
     def hvac_mode(self):
-        if self.uponor_client.uhome.by_name('hc_mode').value == 1:
-            return HVACMode.COOL
-
-        return HVACMode.HEAT
+        return HVACMode.COOL if self._state.cooling else HVACMode.HEAT
 
     @property
     def hvac_action(self):
-        if self.thermostat.by_name('room_in_demand').value == 0:
+        if not self._state.in_demand:
             return HVACAction.IDLE
-        
-        if self.hvac_mode == HVACMode.HEAT:
-            return HVACAction.HEATING
-        else:
-            return HVACAction.COOLING
+        return HVACAction.COOLING if self._state.cooling else HVACAction.HEATING
 
     # ** Actions **
+    @property
+    def should_poll(self):
+        # Updated by the Uponor client after each poll and write
+        return False
+
+    async def async_added_to_hass(self):
+        uhome = self.uponor_client.uhome
+        self.async_on_remove(self.uponor_client.subscribe(self._async_handle_update, [self.thermostat]))
+        self.async_on_remove(self.uponor_client.subscribe(self._async_handle_update, [uhome], names=(
+            'hc_mode', 'forced_eco_mode', ATTR_REMOTE_ACCESS_ALARM, ATTR_DEVICE_LOST_ALARM)))
+
+    @callback
+    def _async_handle_update(self, device, changed):
+        # Also after a failed update: the latest state carries the read times of the last successful one
+        self._state = self.thermostat.state
+        self._available = self._state.valid
+        if changed is None and device is not self.thermostat:
+            # After a failed update the cached values stay available until they are stale, the U@Home keeps its last HC mode
+            return
+        self.async_write_ha_state()
+
     async def async_update(self):
         # Update Uhome (to get HC mode) and thermostat
         try:
             await self.uponor_client.update_devices(self.uponor_client.uhome, self.thermostat)
-            valid = self.thermostat.is_valid()
+            self._state = self.thermostat.state
+            valid = self._state.valid
             self._available = valid
             if not valid:
                 _LOGGER.debug("The thermostat '%s' had invalid data, and is therefore unavailable", self.identity)
         except Exception as ex:
-            self._available = False
+            # Cached values stay available until they are stale
             _LOGGER.error("Uponor thermostat was unable to update: %s", ex)
 
     async def async_set_hvac_mode(self, hvac_mode):
@@ -171,7 +196,10 @@ class UponorThermostat(ClimateEntity):
             value = UHOME_MODE_HEAT
         else:
             value = UHOME_MODE_COOL
-        await self.thermostat.set_hvac_mode(value)
+        try:
+            await self.thermostat.set_hvac_mode(value)
+        except UponorAPIException as ex:
+            raise HomeAssistantError(str(ex)) from ex
         self.uponor_client.uhome.last_update = None
         self.async_write_ha_state()
 
@@ -187,7 +215,10 @@ class UponorThermostat(ClimateEntity):
             value = UHOME_MODE_ECO
         else:
             value = UHOME_MODE_COMFORT
-        await self.thermostat.set_preset_mode(value)
+        try:
+            await self.thermostat.set_preset_mode(value)
+        except UponorAPIException as ex:
+            raise HomeAssistantError(str(ex)) from ex
         self.uponor_client.uhome.last_update = None
         self.thermostat.last_update = None
         self.async_write_ha_state()
@@ -196,7 +227,10 @@ class UponorThermostat(ClimateEntity):
         if kwargs.get(ATTR_TEMPERATURE) is None:
             return
         temperature = kwargs.get(ATTR_TEMPERATURE)
-        await self.thermostat.set_setpoint(temperature)
+        try:
+            await self.thermostat.set_setpoint(temperature)
+        except UponorAPIException as ex:
+            raise HomeAssistantError(str(ex)) from ex
         self.thermostat.last_update = None
         self.async_write_ha_state()
             
@@ -10,16 +10,41 @@ import voluptuous as vol
 from homeassistant.const import (CONF_HOST, CONF_PREFIX)
 from .uponor_api.const import DOMAIN
 from .uponor_api import UponorClient, UponorAPIException
+from .uponor_api.discovery import discover, network_hosts
 
 _LOGGER = logging.getLogger(__name__)
 
 CONF_SUPPORTS_HEATING = "supports_heating"
 CONF_SUPPORTS_COOLING = "supports_cooling"
+# Choice of the pick step to enter the host instead
+CONF_MANUAL = "manual"
 
 class UhomeuponorConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     """Uponor config flow."""
     VERSION = 1
 
+    def __init__(self):
+        # Gateways found by discovery, None before discovery ran
+        self._discovered = None
+
+    async def _async_discover(self):
+        """Probes the local IPv4 networks for U@Home gateways"""
+        from homeassistant.components import network
+
+        hosts = {}
+        try:
+            for adapter in await network.async_get_adapters(self.hass):
+                if not adapter["enabled"]:
+                    continue
+                for ip_info in adapter["ipv4"]:
+                    # Only the /24 of the address in larger networks
+                    prefix = max(ip_info["network_prefix"], 24)
+                    hosts.update(dict.fromkeys(network_hosts(f"{ip_info['address']}/{prefix}")))
+            return await discover(async_get_clientsession(self.hass), hosts)
+        except Exception as ex:
+            _LOGGER.warning("Discovery of Uponor gateways failed: %s", ex)
+            return []
+
     async def _async_validate_connection(self, host: str) -> bool:
         """Validate connectivity to Uponor gateway with a simple ping.
 
@@ -53,6 +78,10 @@ class UhomeuponorConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         _LOGGER.info("Init config step uhomeuponor")
         if self._async_current_entries():
             return self.async_abort(reason="single_instance_allowed")
+        if user_input is None and self._discovered is None:
+            self._discovered = await self._async_discover()
+            if self._discovered:
+                return await self.async_step_pick()
         if user_input is not None:
             _LOGGER.debug("user_input: %s", user_input)
             try:
@@ -75,11 +104,15 @@ class UhomeuponorConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 _LOGGER.exception("Unexpected error while creating config entry")
                 errors["base"] = "cannot_connect"
 
+        return self._async_show_user_form(errors)
+
+    def _async_show_user_form(self, errors, host=None):
+        host_key = vol.Required(CONF_HOST) if host is None else vol.Required(CONF_HOST, default=host)
         return self.async_show_form(
             step_id="user",
             data_schema=vol.Schema(
                 {
-                    vol.Required(CONF_HOST): str,
+                    host_key: str,
                     vol.Optional(CONF_PREFIX): str,
                     vol.Optional(CONF_SUPPORTS_HEATING, default=True): bool,
                     vol.Optional(CONF_SUPPORTS_COOLING, default=True): bool,
@@ -87,6 +120,20 @@ class UhomeuponorConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             ), errors=errors
         )
 
+    async def async_step_pick(self, user_input=None):
+        """Offers the discovered gateways, the user step then completes the configuration"""
+        if user_input is not None:
+            host = user_input[CONF_HOST]
+            return self._async_show_user_form({}, None if host == CONF_MANUAL else host)
+
+        choices = {gateway.host: f"{gateway.host} (module {gateway.module_id}, {len(gateway.controllers)} controllers)"
+                   for gateway in self._discovered}
+        choices[CONF_MANUAL] = "Enter manually"
+        return self.async_show_form(
+            step_id="pick",
+            data_schema=vol.Schema({vol.Required(CONF_HOST): vol.In(choices)}),
+        )
+
     @staticmethod
     @callback
     def async_get_options_flow(entry: config_entries.ConfigEntry):
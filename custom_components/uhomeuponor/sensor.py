@@ -4,16 +4,49 @@ Exposes Sensors for Uponor devices, such as:
 - Temperature (UponorThermostatTemperatureSensor)
 - Humidity (UponorThermostatHumiditySensor)
 - Battery (UponorThermostatBatterySensor)
+- Extended thermostat registers (UponorThermostatExtendedSensor), disabled by default
+- Room and controller duty cycles (UponorDutyCycleSensor)
+- House-level aggregates over all thermostats (UponorAggregateSensor)
 """
 
 from homeassistant.components.sensor import SensorDeviceClass, SensorStateClass, SensorEntity
-from homeassistant.const import CONF_PREFIX, UnitOfTemperature
+from homeassistant.const import CONF_PREFIX, PERCENTAGE, UnitOfTemperature
+from homeassistant.core import callback
 from logging import getLogger
 
-from .uponor_api.const import (DOMAIN, UNIT_BATTERY, UNIT_HUMIDITY)
+from .uponor_api.const import (ATTR_RESTORED, DOMAIN, UNIT_BATTERY, UNIT_HUMIDITY, UHOME_MODE_COOL)
+from .uponor_api.history import DUTY_WINDOWS
 
 _LOGGER = getLogger(__name__)
 
+# Extended thermostat registers exposed as sensors: register -> (name suffix, unit, device class, icon)
+EXTENDED_SENSORS = {
+    'utilization_factor_24h': ("Utilization 24h", PERCENTAGE, None, 'mdi:gauge'),
+    'utilization_factor_7d': ("Utilization 7d", PERCENTAGE, None, 'mdi:gauge'),
+    'min_floor_temp': ("Min floor temperature", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer-chevron-down'),
+    'max_floor_temp': ("Max floor temperature", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer-chevron-up'),
+    'min_setpoint': ("Min setpoint", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer-chevron-down'),
+    'max_setpoint': ("Max setpoint", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer-chevron-up'),
+    'rh_setpoint': ("Humidity setpoint", PERCENTAGE, None, 'mdi:water-percent'),
+    'regulation_mode': ("Regulation mode", None, None, 'mdi:tune'),
+}
+
+# Duty cycle windows enabled by default, the others can be enabled in the entity registry
+DUTY_WINDOWS_ENABLED = ('24h',)
+
+# House-level aggregates exposed as sensors: aggregate -> (name suffix, unit, device class, icon)
+AGGREGATE_SENSORS = {
+    'average_temperature': ("Average temperature", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer'),
+    'min_temperature': ("Min temperature", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer-chevron-down'),
+    'max_temperature': ("Max temperature", UnitOfTemperature.CELSIUS, SensorDeviceClass.TEMPERATURE, 'mdi:thermometer-chevron-up'),
+    'max_humidity': ("Max humidity", UNIT_HUMIDITY, SensorDeviceClass.HUMIDITY, 'mdi:water-percent'),
+    'average_setpoint_deviation': ("Average setpoint deviation", UnitOfTemperature.CELSIUS, None, 'mdi:thermometer-minus'),
+    'max_setpoint_deviation': ("Max setpoint deviation", UnitOfTemperature.CELSIUS, None, 'mdi:thermometer-alert'),
+    'rooms_in_demand': ("Rooms in demand", None, None, 'mdi:radiator'),
+    'battery_alarms': ("Battery alarms", None, None, 'mdi:battery-alert'),
+    'rf_alarms': ("RF alarms", None, None, 'mdi:signal-off'),
+}
+
 
 async def async_setup_entry(hass, config_entry, async_add_entities):
     _LOGGER.info("init setup sensor platform for id: %s data: %s, options: %s", config_entry.entry_id, config_entry.data, config_entry.options)
@@ -22,29 +55,57 @@ async def async_setup_entry(hass, config_entry, async_add_entities):
 
     uponor = hass.data[DOMAIN][config_entry.entry_id]["client"]
 
-    async_add_entities([UponorThermostatTemperatureSensor(prefix, uponor, thermostat)
-                  for thermostat in uponor.thermostats], True)
+    entities = []
+
+    entities.extend(UponorThermostatTemperatureSensor(prefix, uponor, thermostat)
+                  for thermostat in uponor.thermostats)
+
+    entities.extend(UponorThermostatHumiditySensor(prefix, uponor, thermostat)
+                  for thermostat in uponor.thermostats)
+
+    entities.extend(UponorThermostatBatterySensor(prefix, uponor, thermostat)
+                  for thermostat in uponor.thermostats)
+
+    entities.extend(UponorThermostatExtendedSensor(prefix, uponor, thermostat, register)
+                  for thermostat in uponor.thermostats
+                  for register in EXTENDED_SENSORS)
 
-    async_add_entities([UponorThermostatHumiditySensor(prefix, uponor, thermostat)
-                  for thermostat in uponor.thermostats], True)
+    entities.extend(UponorDutyCycleSensor(prefix, uponor, device, window)
+                  for device in uponor.controllers + uponor.thermostats
+                  for window in DUTY_WINDOWS)
 
-    async_add_entities([UponorThermostatBatterySensor(prefix, uponor, thermostat)
-                  for thermostat in uponor.thermostats], True)
+    entities.extend(UponorAggregateSensor(prefix, uponor, aggregate)
+                  for aggregate in AGGREGATE_SENSORS)
+
+    # Used to apply option changes in place
+    hass.data[DOMAIN][config_entry.entry_id]["entities"].extend(entities)
+
+    # Entities start from the values read by rescan, the first updates come with the regular polls
+    async_add_entities(entities)
 
     _LOGGER.info("finish setup sensor platform for Uhome Uponor")
     return True
 
-class UponorThermostatTemperatureSensor(SensorEntity):
-    """HA Temperature sensor entity. Utilizes Uponor U@Home API to interact with U@Home"""
+class UponorThermostatSensor(SensorEntity):
+    """Base of the HA sensor entities of a thermostat's core registers. Utilizes Uponor U@Home API to interact with U@Home.
+    Subclasses set the name and unique id suffixes, and the registers their state depends on"""
+
+    name_suffix = ""
+    identity_suffix = None
+    # The kind of sensor, for log messages
+    sensor_kind = None
+    # room_temperature and room_setpoint decide whether the thermostat is valid
+    subscribed_registers = ('room_temperature', 'room_setpoint')
 
     def __init__(self, prefix, uponor_client, thermostat):
-        self._available = False
+        # Seeded from the values read by rescan
+        self._available = thermostat.is_valid()
         self.prefix = prefix
         self.uponor_client = uponor_client
         self.thermostat = thermostat
         self.device_name = f"{prefix or ''}{thermostat.by_name('room_name').value}"
         self.device_id = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}"
-        self.identity = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}_temp"
+        self.identity = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}_{self.identity_suffix}"
 
     @property
     def device_info(self) -> dict:
@@ -57,28 +118,50 @@ class UponorThermostatTemperatureSensor(SensorEntity):
     # ** Generic **
     @property
     def name(self):
-        return f"{self.prefix or ''}{self.thermostat.by_name('room_name').value}"
+        return f"{self.prefix or ''}{self.thermostat.by_name('room_name').value}{self.name_suffix}"
 
     @property
     def unique_id(self):
         return self.identity
 
     @property
-    def icon(self):
-        return 'mdi:thermometer'
+    def available(self):
+        # Invalid values, or values past their hard TTL, are unavailable. Restored values until the first update
+        return self._available and (self.thermostat.restored or not self.thermostat.is_stale())
 
+    # ** State **
     @property
-    def available(self):
-        return self._available
+    def extra_state_attributes(self):
+        # Last-known values from before a restart, until the first update
+        if self.thermostat.restored:
+            return {ATTR_RESTORED: True}
+        return None
+
+    # ** Actions **
+    @property
+    def should_poll(self):
+        # Updated by the Uponor client after each poll and write
+        return False
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self.uponor_client.subscribe(self._async_handle_update, [self.thermostat], names=self.subscribed_registers))
+
+    @callback
+    def _async_handle_update(self, device, changed):
+        if changed is not None:
+            self._available = self.thermostat.is_valid()
+        # After a failed update the cached values stay available until they are stale
+        self.async_write_ha_state()
+
+class UponorThermostatTemperatureSensor(UponorThermostatSensor):
+    """HA Temperature sensor entity. Utilizes Uponor U@Home API to interact with U@Home"""
 
-    # ** DEBUG PROPERTY  **
-    # @property
-    # def extra_state_attributes(self):
-    #     """Return the device state attributes."""
-    #     attr = self.thermostat.attributes() + self.uponor_client.uhome.attributes()
-    #     return {
-    #         ATTR_ATTRIBUTION: attr,
-    #     }
+    identity_suffix = "temp"
+    sensor_kind = "temperature"
+
+    @property
+    def icon(self):
+        return 'mdi:thermometer'
 
     # ** Static **
     @property
@@ -96,32 +179,78 @@ class UponorThermostatTemperatureSensor(SensorEntity):
     # ** State **
     @property
     def native_value(self):
-        return self.thermostat.by_name('room_temperature').value
+        return self.thermostat.get('room_temperature')
 
-    # ** Actions **
-    async def async_update(self):
-        # Update thermostat
-        try:
-            await self.thermostat.async_update()
-            valid = self.thermostat.is_valid()
-            self._available = valid
-            if not valid:
-                _LOGGER.debug("The thermostat temperature sensor '%s' had invalid data, and is therefore unavailable", self.identity)
-        except Exception as ex:
-            self._available = False
-            _LOGGER.error("Uponor thermostat temperature sensor was unable to update: %s", ex)
-
-class UponorThermostatHumiditySensor(SensorEntity):
+class UponorThermostatHumiditySensor(UponorThermostatSensor):
     """HA Humidity sensor entity. Utilizes Uponor U@Home API to interact with U@Home"""
 
-    def __init__(self, prefix, uponor_client, thermostat):
+    name_suffix = " Humidity"
+    identity_suffix = "rh"
+    sensor_kind = "humidity"
+    subscribed_registers = ('rh_value', 'room_temperature', 'room_setpoint')
+
+    @property
+    def icon(self):
+        return 'mdi:water-percent'
+
+    # ** Static **
+    @property
+    def native_unit_of_measurement(self):
+        return UNIT_HUMIDITY
+
+    @property
+    def device_class(self):
+        return SensorDeviceClass.HUMIDITY
+
+    @property
+    def state_class(self):
+        return SensorStateClass.MEASUREMENT
+
+    # ** State **
+    @property
+    def native_value(self):
+        return self.thermostat.get('rh_value')
+
+class UponorThermostatBatterySensor(UponorThermostatSensor):
+    """HA Battery sensor entity. Utilizes Uponor U@Home API to interact with U@Home"""
+
+    name_suffix = " Battery"
+    identity_suffix = "batt"
+    sensor_kind = "battery"
+    subscribed_registers = ('battery_alarm', 'room_temperature', 'room_setpoint')
+
+    # ** Static **
+    @property
+    def native_unit_of_measurement(self):
+        return UNIT_BATTERY
+
+    @property
+    def device_class(self):
+        return SensorDeviceClass.BATTERY
+
+    # ** State **
+    @property
+    def native_value(self):
+        # If there is a battery alarm, report a low level - else report 100%
+        if self.thermostat.get('battery_alarm'):
+            return 10
+
+        return 100
+
+class UponorThermostatExtendedSensor(SensorEntity):
+    """HA sensor entity for an extended thermostat register. The register is only polled while the entity is enabled"""
+
+    def __init__(self, prefix, uponor_client, thermostat, register):
+        # Extended registers are not read by rescan, the first extended update makes the entity available
         self._available = False
         self.prefix = prefix
         self.uponor_client = uponor_client
         self.thermostat = thermostat
+        self.register = register
+        self.suffix, self.unit, self.sensor_device_class, self.sensor_icon = EXTENDED_SENSORS[register]
         self.device_name = f"{prefix or ''}{thermostat.by_name('room_name').value}"
         self.device_id = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}"
-        self.identity = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}_rh"
+        self.identity = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}_{register}"
 
     @property
     def device_info(self) -> dict:
@@ -134,7 +263,7 @@ class UponorThermostatHumiditySensor(SensorEntity):
     # ** Generic **
     @property
     def name(self):
-        return f"{self.prefix or ''}{self.thermostat.by_name('room_name').value} Humidity"
+        return f"{self.prefix or ''}{self.thermostat.by_name('room_name').value} {self.suffix}"
 
     @property
     def unique_id(self):
@@ -142,55 +271,163 @@ class UponorThermostatHumiditySensor(SensorEntity):
 
     @property
     def icon(self):
-        return 'mdi:water-percent'
+        return self.sensor_icon
 
     @property
     def available(self):
-        return self._available
+        return self._available and not self.thermostat.is_stale(self.register)
+
+    @property
+    def entity_registry_enabled_default(self):
+        return False
 
     # ** Static **
     @property
     def native_unit_of_measurement(self):
-        return UNIT_HUMIDITY
+        return self.unit
 
     @property
     def device_class(self):
-        return SensorDeviceClass.HUMIDITY
+        return self.sensor_device_class
 
     @property
     def state_class(self):
+        if self.unit is None:
+            return None
         return SensorStateClass.MEASUREMENT
 
     # ** State **
     @property
     def native_value(self):
-        return self.thermostat.by_name('rh_value').value
+        return self.thermostat.get(self.register)
 
     # ** Actions **
-    async def async_update(self):
-        # Update thermostat
-        try:
-            await self.thermostat.async_update()
-            valid = self.thermostat.is_valid()
-            self._available = valid
-
-            if not valid:
-                _LOGGER.debug("The thermostat humidity sensor '%s' had invalid data, and is therefore unavailable", self.identity)
-        except Exception as ex:
-            self._available = False
-            _LOGGER.error("Uponor thermostat humidity sensor was unable to update: %s", ex)
-
-class UponorThermostatBatterySensor(SensorEntity):
-    """HA Battery sensor entity. Utilizes Uponor U@Home API to interact with U@Home"""
+    @property
+    def should_poll(self):
+        # Updated by the Uponor client after each extended update
+        return False
+
+    async def async_added_to_hass(self):
+        # Only poll the register while this entity is enabled
+        self.thermostat.request_extended(self.register)
+        self.async_on_remove(self.uponor_client.subscribe(self._async_handle_update, [self.thermostat], names=(self.register,)))
+
+    async def async_will_remove_from_hass(self):
+        self.thermostat.release_extended(self.register)
+
+    @callback
+    def _async_handle_update(self, device, changed):
+        # After a failed update the cached value stays available until it is stale
+        self._available = self.thermostat.extended_last_update is not None
+        self.async_write_ha_state()
+
+class UponorDutyCycleSensor(SensorEntity):
+    """HA duty cycle sensor entity, for a thermostat (room in demand) or a controller (any room in demand).
+    The duty cycle is accumulated by the Uponor client from every poll"""
+
+    def __init__(self, prefix, uponor_client, device, window):
+        self._available = device.last_update is not None
+        self.prefix = prefix
+        self.uponor_client = uponor_client
+        self.device = device
+        self.window = window
 
-    def __init__(self, prefix, uponor_client, thermostat):
-        self._available = False
+        if hasattr(device, 'thermostat_index'):
+            self.device_name = f"{prefix or ''}{device.by_name('room_name').value}"
+            self.device_id = f"{prefix or ''}controller{device.controller_index}_thermostat{device.thermostat_index}"
+        else:
+            self.device_name = f"{prefix or ''}Controller {device.controller_index}"
+            self.device_id = f"{prefix or ''}controller{device.controller_index}"
+        self.identity = f"{self.device_id}_duty_{window}"
+
+    @property
+    def device_info(self) -> dict:
+        """Return info for device registry."""
+        return {
+            "identifiers": {(DOMAIN, self.device_id)},
+            "name": self.device_name,
+        }
+
+    # ** Generic **
+    @property
+    def name(self):
+        if hasattr(self.device, 'thermostat_index'):
+            return f"{self.prefix or ''}{self.device.by_name('room_name').value} Duty cycle {self.window}"
+        return f"{self.device_name} Duty cycle {self.window}"
+
+    @property
+    def unique_id(self):
+        return self.identity
+
+    @property
+    def icon(self):
+        return 'mdi:radiator'
+
+    @property
+    def available(self):
+        return self._available
+
+    @property
+    def entity_registry_enabled_default(self):
+        return self.window in DUTY_WINDOWS_ENABLED
+
+    # ** Static **
+    @property
+    def native_unit_of_measurement(self):
+        return PERCENTAGE
+
+    @property
+    def state_class(self):
+        return SensorStateClass.MEASUREMENT
+
+    # ** State **
+    @property
+    def native_value(self):
+        value = self.device.demand.value(self.window)
+        if value is None:
+            return None
+        return round(value * 100, 1)
+
+    @property
+    def extra_state_attributes(self):
+        if self.uponor_client.uhome.by_name('hc_mode').value == UHOME_MODE_COOL:
+            return {"mode": "cooling"}
+        return {"mode": "heating"}
+
+    # ** Actions **
+    @property
+    def should_poll(self):
+        # Updated by the Uponor client after each poll of the thermostats
+        return False
+
+    async def async_added_to_hass(self):
+        # The duty cycle moves with time, so every update is delivered, not only changes
+        if hasattr(self.device, 'thermostat_index'):
+            devices = [self.device]
+        else:
+            devices = [thermostat for thermostat in self.uponor_client.thermostats
+                       if thermostat.controller_index == self.device.controller_index]
+        self.async_on_remove(self.uponor_client.subscribe(self._async_handle_update, devices, changes_only=False))
+
+    @callback
+    def _async_handle_update(self, device, changed):
+        # The demand samples stop while the thermostats are not read, available until their values are stale
+        self._available = not device.is_stale()
+        self.async_write_ha_state()
+
+class UponorAggregateSensor(SensorEntity):
+    """HA sensor entity for a house-level aggregate over all thermostats of the U@Home gateway"""
+
+    def __init__(self, prefix, uponor_client, aggregate):
+        self._available = aggregate in uponor_client.aggregates
+        self._written_value = None
         self.prefix = prefix
         self.uponor_client = uponor_client
-        self.thermostat = thermostat
-        self.device_name = f"{prefix or ''}{thermostat.by_name('room_name').value}"
-        self.device_id = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}"
-        self.identity = f"{prefix or ''}controller{thermostat.controller_index}_thermostat{thermostat.thermostat_index}_batt"
+        self.aggregate = aggregate
+        self.suffix, self.unit, self.sensor_device_class, self.sensor_icon = AGGREGATE_SENSORS[aggregate]
+        self.device_name = f"{prefix or ''}U@Home"
+        self.device_id = f"{prefix or ''}uhome"
+        self.identity = f"{prefix or ''}uhome_{aggregate}"
 
     @property
     def device_info(self) -> dict:
@@ -203,12 +440,16 @@ class UponorThermostatBatterySensor(SensorEntity):
     # ** Generic **
     @property
     def name(self):
-        return f"{self.prefix or ''}{self.thermostat.by_name('room_name').value} Battery"
+        return f"{self.prefix or ''}{self.suffix}"
 
     @property
     def unique_id(self):
         return self.identity
 
+    @property
+    def icon(self):
+        return self.sensor_icon
+
     @property
     def available(self):
         return self._available
@@ -216,31 +457,37 @@ class UponorThermostatBatterySensor(SensorEntity):
     # ** Static **
     @property
     def native_unit_of_measurement(self):
-        return UNIT_BATTERY
+        return self.unit
 
     @property
     def device_class(self):
-        return SensorDeviceClass.BATTERY
+        return self.sensor_device_class
+
+    @property
+    def state_class(self):
+        return SensorStateClass.MEASUREMENT
 
     # ** State **
     @property
     def native_value(self):
-        # If there is a battery alarm, report a low level - else report 100%
-        if self.thermostat.by_name('battery_alarm').value == 1:
-            return 10
-
-        return 100
+        value = self.uponor_client.aggregates.get(self.aggregate)
+        if isinstance(value, float):
+            return round(value, 1)
+        return value
 
     # ** Actions **
-    async def async_update(self):
-        # Update thermostat
-        try:
-            await self.thermostat.async_update()
-            valid = self.thermostat.is_valid()
-            self._available = valid
-
-            if not valid:
-                _LOGGER.debug("The thermostat battery sensor '%s' had invalid data, and is therefore unavailable", self.identity)
-        except Exception as ex:
-            self._available = False
-            _LOGGER.error("Uponor thermostat battery sensor was unable to update: %s", ex)
+    @property
+    def should_poll(self):
+        # Updated by the Uponor client after each update of any device
+        return False
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self.uponor_client.subscribe(self._async_handle_update, changes_only=False))
+
+    @callback
+    def _async_handle_update(self, device, changed):
+        # Called for every device, only write when the aggregate moved. A failing device keeps its last values in the aggregates
+        state = (self.aggregate in self.uponor_client.aggregates, self.native_value)
+        if state != (self._available, self._written_value):
+            self._available, self._written_value = state
+            self.async_write_ha_state()
@@ -1,24 +1,66 @@
-"""UHome Uponor API client"""
+"""UHome Uponor API client
+
+Standalone library, it must not import Home Assistant. See cli.py for a command line interface.
+"""
 
 import asyncio
+import itertools
 import logging
 import json
+import time
 
 import aiohttp
+from collections import Counter, namedtuple
 from datetime import datetime, timedelta
 from abc import ABC, abstractmethod
-from homeassistant.exceptions import HomeAssistantError
+from types import MappingProxyType
 
 from .const import *
 from .utilities import *
+from .history import RegisterHistory, DutyCycle
+from .registers import POLL_CORE, POLL_EXTENDED, UHOME_LAYOUT, CONTROLLER_LAYOUT, THERMOSTAT_LAYOUT, UponorValueStore
 
 _LOGGER = logging.getLogger(__name__)
 
 REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3, sock_connect=3, sock_read=7)
 REQUEST_RETRIES = 2
 RETRY_DELAY_SECONDS = 1
-
-class UponorAPIException(HomeAssistantError):
+# Requests are not started, or retried, with less budget left than this
+MIN_REQUEST_SECONDS = 1
+# Budget of an update cycle when the caller does not pass a Deadline
+CYCLE_TIMEOUT_SECONDS = 30
+
+# Adaptive polling: a thermostat is polled at the floor interval after changes, temperature moves of at least
+# ADAPTIVE_TEMPERATURE_STEP between polls or ADAPTIVE_TEMPERATURE_RATE per hour (over ADAPTIVE_RATE_WINDOW),
+# and the interval grows by ADAPTIVE_BACKOFF on every stable poll, up to the ceiling
+ADAPTIVE_TEMPERATURE_STEP = 0.3
+ADAPTIVE_TEMPERATURE_RATE = 1.0
+ADAPTIVE_RATE_WINDOW = 900
+ADAPTIVE_BACKOFF = 1.5
+
+# Quarantine: a thermostat failing is_valid() after QUARANTINE_INVALID_UPDATES updates in a row, or with its responses
+# rejected by rejected_devices() QUARANTINE_REJECTED_UPDATES times in a row, e.g. a flat battery or a removed thermostat,
+# is only probed every QUARANTINE_PROBE_INTERVAL, reading QUARANTINE_PROBE_REGISTERS, until it is valid again
+QUARANTINE_INVALID_UPDATES = 3
+QUARANTINE_REJECTED_UPDATES = 5
+QUARANTINE_PROBE_INTERVAL = timedelta(minutes=10)
+QUARANTINE_PROBE_REGISTERS = ('room_temperature', 'room_setpoint')
+
+# Shards: after SHARD_DEGRADED_FAILURES failed cycles in a row a controller is degraded. It fails fast, with
+# SHARD_DEGRADED_TIMEOUT and no retries, and is only tried again after a backoff doubling from SHARD_MIN_BACKOFF_SECONDS
+SHARD_DEGRADED_FAILURES = 3
+SHARD_DEGRADED_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=3, sock_connect=3, sock_read=4)
+SHARD_MIN_BACKOFF_SECONDS = 30
+SHARD_MAX_BACKOFF_SECONDS = 300
+# Requests in flight to the gateway, over all shards
+MAX_CONCURRENT_REQUESTS = 2
+# JSON-RPC calls packed into one HTTP request, if the gateway accepts batches, see UponorClient.do_batch_call()
+MAX_BATCH_CALLS = 3
+
+# Format of UponorClient.snapshot()
+SNAPSHOT_VERSION = 1
+
+class UponorAPIException(Exception):
     def __init__(self, message, inner_exception=None):
         if inner_exception:
             super().__init__(f"{message}: {inner_exception}")
@@ -26,78 +68,277 @@ class UponorAPIException(HomeAssistantError):
             super().__init__(message)
         self.inner_exception = inner_exception
 
+class UponorDeadlineException(UponorAPIException):
+    """The Deadline of a cycle ran out before a request could complete"""
+    pass
+
+class ThermostatState(namedtuple('ThermostatState', [
+        'room_name', 'room_temperature', 'room_setpoint', 'rh_value', 'in_demand', 'cooling', 'forced_eco',
+        'alarms', 'valid', 'restored', 'stale_at'])):
+    """Immutable state of a thermostat, published after every update, see UponorThermostat.publish_state().
+    cooling and forced_eco come from the U@Home, alarms maps the alarm registers of the thermostat and the U@Home
+    to their values, stale_at is the monotonic time the first core value goes stale, None if one was never read"""
+
+    __slots__ = ()
+
+    def is_stale(self, now=None):
+        return self.stale_at is None or (now or time.monotonic()) > self.stale_at
+
+class UponorStatusException(UponorAPIException):
+    """The gateway answered with an HTTP error status"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
 class UponorClient(object):
     """API Client for Uponor U@Home API"""
 
     def __init__(self, hass, server, session: aiohttp.ClientSession):
+        # hass is not used by the client, it may be None when used outside of Home Assistant
         self.hass = hass
         self.server = server
         self.session = session
+        # Values of all devices, devices are views onto blocks of this store
+        self.store = UponorValueStore()
         self.uhome = UponorUhome(self)
         self.controllers = []
         self.thermostats = []
+        # Controllers by (controller_index, None) and thermostats by (controller_index, thermostat_index)
+        self._devices_by_index = {}
 
         self.max_update_interval = timedelta(seconds=60)
+        # Thermostats adapt their interval between the floor and the ceiling, see UponorThermostat.sample()
+        self.adaptive_polling = True
+        self.update_interval_floor = timedelta(seconds=30)
+        self.update_interval_ceiling = timedelta(minutes=5)
+        self.extended_update_interval = timedelta(minutes=10)
         self.max_values_batch = 40
-        self._update_lock = asyncio.Lock()
+        # Request timeout and retries, the module constants unless tuned
+        self.timeout = REQUEST_TIMEOUT
+        self.retries = REQUEST_RETRIES
+        self.retry_delay = RETRY_DELAY_SECONDS
+        # Update work by controller index, None for the U@Home, see UponorShard
+        self.shards = {}
+        self.max_concurrent_requests = MAX_CONCURRENT_REQUESTS
+        self._request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # JSON-RPC batches: None until the gateway answered the first one, then whether it accepts them
+        self.batch_calls = None
+        self.max_batch_calls = MAX_BATCH_CALLS
+        self._request_ids = itertools.count(1)
+
+        # Listeners by device, None for all devices, see subscribe()
+        self._listeners = {}
+        # Background refreshes started by UponorBaseDevice.get(), by (device, extended), kept referenced until done
+        self._refresh_tasks = {}
+
+        # Recent samples of every register read, for trend queries without the recorder
+        self.history = RegisterHistory(360)
+
+        # House-level aggregates over all thermostats, see update_aggregates()
+        self.aggregates = {}
 
         self.server_uri = f"http://{self.server}/api"
 
-    async def rescan(self):
-        # Initialize
-        await self.uhome.async_update()
-        await self.init_controllers()
-        await self.init_thermostats()
+        # Number of HTTP requests made, including retries
+        self.request_count = 0
+        # Number of responses with thermostats rejected by rejected_devices()
+        self.rejected_count = 0
+        # Number of values dropped because their codec could not decode them, see codec.py
+        self.malformed_count = 0
+        # Time of the last successful request, see time_since_success()
+        self.last_success = None
+
+    async def rescan(self, deadline=None):
+        # Initialize, all within one deadline
+        if deadline is None:
+            deadline = Deadline(CYCLE_TIMEOUT_SECONDS * 2)
+        await self.uhome.async_update(deadline=deadline)
+        await self.init_controllers(deadline=deadline)
+        await self.init_thermostats(deadline=deadline)
+
+    async def revalidate(self, deadline=None):
+        """Re-reads all devices in place, e.g. after an outage, keeping the device objects.
+        Returns False, with the devices unchanged, when controllers or thermostats were added or removed"""
+        if deadline is None:
+            deadline = Deadline(CYCLE_TIMEOUT_SECONDS * 2)
+
+        # After an outage every shard may be backing off for minutes, this is the attempt they wait for
+        for shard in self.shards.values():
+            shard.retry_now()
+
+        self.uhome.last_update = None
+        await self.update_devices(self.uhome, deadline=deadline)
+        if self.present_controllers() != [controller.controller_index for controller in self.controllers]:
+            _LOGGER.info("Controllers changed from %s to %s", [controller.controller_index for controller in self.controllers], self.present_controllers())
+            return False
 
-    async def init_controllers(self):
-        """
-        Identifies present controllers from U@Home.
-        """
+        for controller in self.controllers:
+            controller.last_update = None
+        await self.update_devices(self.controllers, deadline=deadline)
+        if self.present_thermostats() != [(thermostat.controller_index, thermostat.thermostat_index) for thermostat in self.thermostats]:
+            _LOGGER.info("Thermostats changed to %s", self.present_thermostats())
+            return False
 
-        self.controllers.clear()
+        for thermostat in self.thermostats:
+            thermostat.last_update = None
+        await self.update_devices(self.thermostats, deadline=deadline)
+        return True
 
+    def present_controllers(self):
+        """Returns the indexes of the controllers present, from the U@Home values"""
         # A value of 3 (0011) will indicate that controllers 0 (0001) and 1 (0010) are present
         bitMask = self.uhome.by_name("controller_presence").value
+        return [i for i in range(0, 4) if bitMask & (1 << i)]
 
-        for i in range(0, 4):
-            mask = 1 << i
+    def present_thermostats(self):
+        """Returns (controller_index, thermostat_index) of the thermostats present, from the controller values"""
+        # A value of 31 (0000 0001 1111) will indicate that thermostats 0 (0000 0000 0001) through 4 (0000 0001 0000) are present
+        present = []
+        for controller in self.controllers:
+            bitMask = controller.by_name('thermostat_presence').value
+            present.extend((controller.controller_index, i) for i in range(0, 12) if bitMask & (1 << i))
+        return present
+
+    def snapshot(self):
+        """Returns the topology and all values as a JSON serializable dict, or None before the first successful read"""
+        if self.last_success is None:
+            return None
+
+        values = self.store.values
+        return {
+            'version': SNAPSHOT_VERSION,
+            'time': self.last_success.isoformat(),
+            # Values are restored by register name, so layout changes between versions are tolerated
+            'registers': {
+                'uhome': [register.name for register in UHOME_LAYOUT.registers],
+                'controller': [register.name for register in CONTROLLER_LAYOUT.registers],
+                'thermostat': [register.name for register in THERMOSTAT_LAYOUT.registers],
+            },
+            'devices': {device.key: values[device.base:device.base + device.layout.size]
+                        for device in [self.uhome] + self.controllers + self.thermostats},
+        }
+
+    def restore(self, snapshot, max_age=None):
+        """Recreates the devices and their values from a snapshot(), without reading the gateway.
+        Restored devices are flagged restored until their first update. Returns False if the snapshot can't be used,
+        including when it lacks the values of a present device, e.g. a thermostat added since, which needs a rescan"""
+        if not snapshot or snapshot.get('version') != SNAPSHOT_VERSION:
+            return False
+
+        try:
+            if max_age is not None and datetime.now() - datetime.fromisoformat(snapshot['time']) > max_age:
+                _LOGGER.debug("Snapshot from %s is too old to restore", snapshot['time'])
+                return False
+
+            registers = snapshot['registers']
+            devices = snapshot['devices']
+            # Restored values age from the time of the snapshot
+            read_time = time.monotonic() - (datetime.now() - datetime.fromisoformat(snapshot['time'])).total_seconds()
+
+            self.clear_devices()
+            self.restore_values(self.uhome, registers['uhome'], devices['uhome'], read_time)
+
+            for i in self.present_controllers():
+                controller = self.add_controller(i)
+                self.restore_values(controller, registers['controller'], devices.get(controller.key), read_time)
+
+            for controller_index, i in self.present_thermostats():
+                thermostat = self.add_thermostat(controller_index, i)
+                self.restore_values(thermostat, registers['thermostat'], devices.get(thermostat.key), read_time)
+        except (KeyError, TypeError, ValueError) as ex:
+            _LOGGER.warning("Invalid snapshot, not restored: %s", ex)
+            self.clear_devices()
+            self.uhome.restored = False
+            return False
+
+        # Devices without values would come up with the register defaults, e.g. a room named 0
+        missing = [device.key for device in self.controllers + self.thermostats if device.key not in devices]
+        if missing:
+            _LOGGER.info("Snapshot has no values of %s, not restored", ", ".join(missing))
+            self.clear_devices()
+            self.uhome.restored = False
+            return False
+
+        self.update_aggregates()
+        self.publish_states(self.thermostats)
+        return True
+
+    def restore_values(self, device, names, values, read_time=None):
+        if values is None:
+            return
+        for name, value in zip(names, values):
+            register = device.layout.by_name.get(name)
+            if register is None:
+                continue
+            try:
+                value = register.codec.decode(value)
+            except (TypeError, ValueError):
+                continue
+            UponorValue(device, register).value = value
+            self.store.times[device.base + register.slot] = read_time
+        device.restored = True
+
+    def time_since_success(self):
+        """Returns the time since the last successful request, or None before the first one"""
+        if self.last_success is None:
+            return None
+        return datetime.now() - self.last_success
+
+    async def init_controllers(self, deadline=None):
+        """
+        Identifies present controllers from U@Home.
+        """
+
+        self.clear_devices()
+
+        for i in self.present_controllers():
+            self.add_controller(i)
 
-            if bitMask & mask:
-                # Controller i is present
-                self.controllers.append(UponorController(self, i))
-            
         #_LOGGER.debug("Identified %d controllers", len(self.controllers))
 
         # Update all controllers
-        await self.update_devices(self.controllers)
+        await self.update_devices(self.controllers, deadline=deadline)
 
-    async def init_thermostats(self):
+    async def init_thermostats(self, deadline=None):
         """
         Identifies present thermostats from U@Home.
         """
 
         self.thermostats.clear()
 
-        # A value of 31 (0000 0001 1111) will indicate that thermostats 0 (0000 0000 0001) through 4 (0000 0001 0000) are present
-        for controller in self.controllers:
-            bitMask = controller.by_name('thermostat_presence').value
-
-            for i in range(0, 12):
-                mask = 1 << i
+        for controller_index, i in self.present_thermostats():
+            self.add_thermostat(controller_index, i)
 
-                if bitMask & mask:
-                    # Thermostat i is present
-                    self.thermostats.append(UponorThermostat(self, controller.controller_index, i))
-            
         #_LOGGER.debug("Identified %d thermostats on %d controllers", len(self.thermostats), len(self.controllers))
 
         # Update all thermostats
-        await self.update_devices(self.thermostats)
+        await self.update_devices(self.thermostats, deadline=deadline)
+
+    def clear_devices(self):
+        # Controllers and thermostats are recreated, release their values
+        self.controllers.clear()
+        self.thermostats.clear()
+        self._devices_by_index.clear()
+        self.store.truncate(self.uhome.base + self.uhome.layout.size)
+
+    def add_controller(self, controller_index):
+        controller = UponorController(self, controller_index)
+        self.controllers.append(controller)
+        self._devices_by_index[(controller_index, None)] = controller
+        return controller
+
+    def add_thermostat(self, controller_index, thermostat_index):
+        thermostat = UponorThermostat(self, controller_index, thermostat_index)
+        self.thermostats.append(thermostat)
+        self._devices_by_index[(controller_index, thermostat_index)] = thermostat
+        return thermostat
 
     def create_request(self, method):
         req = {
             'jsonrpc': "2.0",
-            'id': 8,
+            # Unique, responses of a batch are matched by id
+            'id': next(self._request_ids),
             'method': method,
             'params': {
                 'objects': []
@@ -109,119 +350,419 @@ class UponorClient(object):
     def add_request_object(self, req, obj):
         req['params']['objects'].append(obj)
 
-    async def do_rest_call(self, requestObject):
+    def set_max_concurrent_requests(self, count):
+        """Limits the requests in flight to the gateway, over all shards"""
+        self.max_concurrent_requests = count
+        self._request_slots = asyncio.Semaphore(count)
+
+    def apply_tuning(self, tuning):
+        """Applies the settings recommended by the profiler, see profiler.py. Missing settings are kept"""
+        if 'max_values_batch' in tuning:
+            self.max_values_batch = int(tuning['max_values_batch'])
+        if 'max_concurrent_requests' in tuning:
+            self.set_max_concurrent_requests(int(tuning['max_concurrent_requests']))
+        if 'timeout' in tuning:
+            total = float(tuning['timeout'])
+            self.timeout = aiohttp.ClientTimeout(total=total, connect=min(REQUEST_TIMEOUT.connect, total),
+                                                 sock_connect=min(REQUEST_TIMEOUT.sock_connect, total),
+                                                 sock_read=min(REQUEST_TIMEOUT.sock_read, total))
+        if 'retries' in tuning:
+            self.retries = int(tuning['retries'])
+        if 'max_batch_calls' in tuning:
+            self.max_batch_calls = int(tuning['max_batch_calls'])
+
+    def request_timeout(self, deadline, timeout=None):
+        """Returns the request timeout, shrunk to fit the deadline"""
+        timeout = timeout or self.timeout
+        if deadline is None or deadline.remaining() >= timeout.total:
+            return timeout
+
+        remaining = deadline.remaining()
+        return aiohttp.ClientTimeout(total=remaining,
+                                     connect=min(timeout.connect, remaining),
+                                     sock_connect=min(timeout.sock_connect, remaining),
+                                     sock_read=min(timeout.sock_read, remaining))
+
+    async def do_rest_call(self, requestObject, deadline=None, timeout=None, retries=None):
+        """Posts a request, or a batch of requests, timeout and retries default to the client settings"""
         data = json.dumps(requestObject)
         last_error = None
+        if retries is None:
+            retries = self.retries
+
+        for attempt in range(retries + 1):
+            if deadline is not None and deadline.remaining() < MIN_REQUEST_SECONDS:
+                raise UponorDeadlineException("API call deadline exceeded", last_error)
 
-        for attempt in range(REQUEST_RETRIES + 1):
             try:
-                async with self.session.post(
-                    self.server_uri,
-                    data=data,
-                    timeout=REQUEST_TIMEOUT,
-                ) as response:
-                    if response.status != 200:
-                        raise UponorAPIException(f"Unsuccessful API call, status {response.status}")
-                    response_data = json.loads(await response.text())
-                    return response_data
-            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                async with self._request_slots:
+                    # The budget may have run out while waiting for a slot, aiohttp takes a total of 0 as no timeout
+                    if deadline is not None and deadline.remaining() < MIN_REQUEST_SECONDS:
+                        raise UponorDeadlineException("API call deadline exceeded", last_error)
+                    self.request_count += 1
+                    async with self.session.post(
+                        self.server_uri,
+                        data=data,
+                        timeout=self.request_timeout(deadline, timeout),
+                    ) as response:
+                        if response.status != 200:
+                            raise UponorStatusException(f"Unsuccessful API call, status {response.status}", response.status)
+                        response_data = json.loads(await response.text())
+                        self.last_success = datetime.now()
+                        return response_data
+            # ValueError: invalid JSON, e.g. a truncated response
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
                 last_error = ex
-                if attempt < REQUEST_RETRIES:
+                if attempt < retries:
+                    # Don't wait for a retry that could not complete within the deadline
+                    if deadline is not None and deadline.remaining() < self.retry_delay + MIN_REQUEST_SECONDS:
+                        raise UponorDeadlineException("API call deadline exceeded", last_error) from last_error
                     try:
-                        await asyncio.sleep(RETRY_DELAY_SECONDS)
+                        await asyncio.sleep(self.retry_delay)
                     except asyncio.CancelledError:
                         raise  # propagate task cancellation immediately
                     continue
                 raise UponorAPIException("API call error", last_error) from last_error
-    
-    async def update_devices(self, *devices):
-        """Updates all values of all devices provided by making API calls. Only devices not updated recently will be considered"""
-        async with self._update_lock:
-            devices = flatten(devices)
-            
-            # Filter devices to include devices if either:
-            # - Device has never been updated
-            # - Device was last updated max_update_interval time ago
-            devices_to_update = [device for device in devices if (not device.pending_update and (device.last_update is None or (datetime.now() - device.last_update) > self.max_update_interval))]
 
-            if len(devices_to_update) == 0:
-                return
+    async def do_batch_call(self, requests, deadline=None, timeout=None, retries=None):
+        """Posts several requests in one JSON-RPC batch, and returns their responses in request order, matched by id.
+        Gateways that do not accept batches get the requests one at a time. Until a batch is answered, a failed batch
+        is retried one request at a time, and batches are turned off if that succeeds"""
+        if len(requests) == 1 or self.batch_calls is False:
+            return [await self.do_rest_call(request, deadline, timeout, retries) for request in requests]
+
+        try:
+            response_data = await self.do_rest_call(requests, deadline, timeout, retries)
+        except UponorDeadlineException:
+            raise
+        except UponorAPIException as ex:
+            # Gateways reject batches with an error status, but also by dropping the connection, timing out or broken JSON
+            if self.batch_calls:
+                raise
+            _LOGGER.debug("Batch request failed, retrying one request at a time: %s", ex)
+            response_data = None
+
+        responses = {}
+        if isinstance(response_data, list):
+            responses = {response.get('id'): response for response in response_data if isinstance(response, dict)}
+        if all(request['id'] in responses for request in requests):
+            self.batch_calls = True
+            return [responses[request['id']] for request in requests]
+
+        if self.batch_calls:
+            raise UponorAPIException(f"Invalid API batch response: {str(response_data)[:200]}")
+        # If the single requests fail too the gateway is down, and the next batch decides
+        responses = [await self.do_rest_call(request, deadline, timeout, retries) for request in requests]
+        if self.batch_calls is None:
+            _LOGGER.info("The gateway at %s does not accept batch requests, sending one request at a time", self.server)
+            self.batch_calls = False
+        return responses
+
+    async def update_devices(self, *devices, deadline=None):
+        """Updates all values of all devices provided by making API calls. Only devices not updated recently will be considered.
+        Devices are updated by the shard of their controller, shards run independently. Devices already being updated
+        are awaited instead of updated again, devices of concurrent calls are merged into the next cycle of their shard.
+        When the deadline runs out, devices fully read so far are still updated before the exception is raised. A cycle
+        shared with other callers may run longer than the deadline, the caller stops waiting and it goes on without it"""
+        devices = flatten(devices)
+
+        now = datetime.now()
+        futures = set()
+        for device in devices:
+            shard = self.shard(device.shard_index)
+            future = shard.futures.get(device)
+            if future is not None:
+                futures.add(future)
+            elif device.is_update_due(now):
+                futures.add(shard.queue_update(device, deadline))
+
+        await self.wait_shards(futures, deadline)
+
+    async def wait_shards(self, futures, deadline=None):
+        # Shielded, a cancelled or timed out caller must not cancel the cycle of the others.
+        # All shards are awaited before an error is raised, so the caller sees every healthy shard completed
+        results = await asyncio.gather(*(self.wait_shard(future, deadline) for future in futures), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    @staticmethod
+    async def wait_shard(future, deadline):
+        if deadline is None:
+            return await asyncio.shield(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), deadline.remaining())
+        except asyncio.TimeoutError:
+            raise UponorDeadlineException(f"Deadline of {deadline.seconds}s ran out waiting for an update cycle")
+
+    def shard(self, index):
+        """Returns the shard of a controller index, None for the U@Home"""
+        shard = self.shards.get(index)
+        if shard is None:
+            shard = self.shards[index] = UponorShard(self, index)
+        return shard
+
+    def complete_update(self, devices):
+        """Marks devices as updated, after all their values were read"""
+        if len(devices) == 0:
+            return
 
-            values = []
-            for device in devices_to_update:
-                values.extend(device.properties_byid.values())
-                device.pending_update = True
+        now = time.monotonic()
+        for device in devices:
+            device.last_update = datetime.now()
+            device.pending_update = False
+            device.restored = False
+            device.sample(now)
+
+        self.update_aggregates()
+        self.publish_states(devices)
+        self.notify(devices)
+
+    def publish_states(self, devices):
+        """Publishes the state of the thermostats among devices, of all thermostats if the U@Home is among them"""
+        thermostats = self.thermostats if self.uhome in devices else [device for device in devices if isinstance(device, UponorThermostat)]
+        for thermostat in thermostats:
+            thermostat.publish_state()
+
+    def subscribe(self, callback, devices=None, names=None, changes_only=True):
+        """Calls callback(device, changed) after updates and writes of the devices given, or of all devices.
+        changed maps the names of changed registers to their new values, limited to names if given. With changes_only
+        the callback is skipped when nothing changed, except for its first call and the first call after a failure.
+        After a failed update changed is None. Returns a function that unsubscribes"""
+        # [callback, names, changes_only, deliver next call]
+        listener = [callback, None if names is None else frozenset(names), changes_only, True]
+        keys = [None] if devices is None else list(devices)
+        for key in keys:
+            self._listeners.setdefault(key, []).append(listener)
+
+        def unsubscribe():
+            for key in keys:
+                self._listeners[key] = [other for other in self._listeners.get(key, []) if other is not listener]
+
+        return unsubscribe
+
+    def notify(self, devices, failed=False):
+        """Calls the listeners of devices with their changed values since the last notification, or with None if failed"""
+        for device in devices:
+            changed = None
+            if not failed:
+                values = self.store.values[device.base:device.base + device.layout.size]
+                previous = device.notified_values
+                device.notified_values = values
+                changed = {register.name: values[register.slot] for register in device.layout.registers
+                           if previous is None or previous[register.slot] != values[register.slot]}
+
+            for listener in self._listeners.get(device, []) + self._listeners.get(None, []):
+                callback, names, changes_only, deliver = listener
+                if changed is None:
+                    listener[3] = True
+                    relevant = None
+                else:
+                    relevant = changed if names is None else {name: value for name, value in changed.items() if name in names}
+                    if changes_only and not relevant and not deliver:
+                        continue
+                    listener[3] = False
+                try:
+                    callback(device, relevant)
+                except Exception:
+                    _LOGGER.exception("Error in listener of %s", device.identity_string)
+
+    async def poll(self, deadline=None):
+        """Updates the U@Home and every thermostat that is due, and the requested extended registers.
+        Meant to be called periodically by subscribers instead of each polling its devices"""
+        errors = []
+        for update in (self.update_devices([self.uhome] + self.thermostats, deadline=deadline),
+                       self.update_extended(self.thermostats, deadline=deadline)):
+            try:
+                await update
+            except UponorAPIException as ex:
+                errors.append(ex)
+        if errors:
+            raise errors[0]
+
+    def refresh_in_background(self, device, extended=False):
+        """Starts an update of the device, or of its extended registers, without waiting for it. Errors are only logged,
+        the values stay cached until they are stale"""
+        key = (device, extended)
+        if key in self._refresh_tasks or device.pending_update or device in self.shard(device.shard_index).futures:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
 
-            #Create dict for all devices
-            allvalues = []
-            for device in self.thermostats:
-                allvalues.extend(device.properties_byid.values())
-            allvalues = flatten(allvalues)
-            allvalue_dict = {}
-            for value in allvalues:
-                allvalue_dict[value.id] = value
+        task = loop.create_task(self.update_extended(device) if extended else self.update_devices(device))
+        self._refresh_tasks[key] = task
+        task.add_done_callback(lambda task: self._refresh_done(key, task))
 
-            try:
-                # Update all values, but at most N at a time
-                for value_list in chunks(values, self.max_values_batch):
-                    await self.update_values(allvalue_dict, value_list)
-            except Exception as e:
-                _LOGGER.exception(e)
-                for device in devices_to_update:
-                    device.pending_update = False
-                raise
+    def _refresh_done(self, key, task):
+        self._refresh_tasks.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            _LOGGER.debug("Background refresh failed: %s", task.exception())
 
-            for device in devices_to_update:
-                device.last_update = datetime.now()
-                device.pending_update = False
+    async def update_extended(self, *devices, deadline=None):
+        """Updates the extended registers requested on the devices provided. Extended registers are
+        polled in their own batches, and only every extended_update_interval"""
+        devices = flatten(devices)
+        if deadline is None:
+            deadline = Deadline(CYCLE_TIMEOUT_SECONDS)
 
-    async def update_values(self, allvalue_dict, *values):
-        """Updates all values provided by making API calls"""
-        values = flatten(values)
+        devices_to_update = [device for device in devices if (len(device.extended_requests) > 0 and not device.quarantined and (device.extended_last_update is None or (datetime.now() - device.extended_last_update) > self.extended_update_interval))]
 
-        if len(values) == 0:
+        if len(devices_to_update) == 0:
             return
 
-        #_LOGGER.debug("Requested update of %d values", len(values))
+        by_shard = {}
+        for device in devices_to_update:
+            by_shard.setdefault(device.shard_index, []).append(device)
+
+        await self.wait_shards([asyncio.ensure_future(self.shard(index).update_extended(shard_devices, deadline))
+                                for index, shard_devices in by_shard.items()])
+
+    def update_aggregates(self):
+        """Computes house-level aggregates over all valid thermostats, in a single pass"""
+        count = 0
+        temperature_sum = 0.0
+        temperature_min = None
+        temperature_max = None
+        humidity_max = None
+        deviation_sum = 0.0
+        deviation_max = None
+        rooms_in_demand = 0
+        battery_alarms = 0
+        rf_alarms = 0
 
-        value_dict = {}
-        for value in values:
-            value_dict[value.id] = value
+        for thermostat in self.thermostats:
+            if not thermostat.is_valid() or thermostat.is_stale():
+                continue
+
+            temperature = thermostat.by_name('room_temperature').value
+            deviation = temperature - thermostat.by_name('room_setpoint').value
+            humidity = thermostat.by_name('rh_value').value
+
+            count += 1
+            temperature_sum += temperature
+            deviation_sum += deviation
+            if temperature_min is None or temperature < temperature_min:
+                temperature_min = temperature
+            if temperature_max is None or temperature > temperature_max:
+                temperature_max = temperature
+            if deviation_max is None or abs(deviation) > abs(deviation_max):
+                deviation_max = deviation
+            # Thermostats without humidity sensor report 0
+            if humidity > 0 and (humidity_max is None or humidity > humidity_max):
+                humidity_max = humidity
+            if thermostat.by_name('room_in_demand').value != 0:
+                rooms_in_demand += 1
+            if thermostat.by_name('battery_alarm').value:
+                battery_alarms += 1
+            if thermostat.by_name('rf_alarm').value:
+                rf_alarms += 1
+
+        if count == 0:
+            self.aggregates = {}
+            return
+
+        self.aggregates = {
+            'average_temperature': temperature_sum / count,
+            'min_temperature': temperature_min,
+            'max_temperature': temperature_max,
+            'max_humidity': humidity_max,
+            'average_setpoint_deviation': deviation_sum / count,
+            'max_setpoint_deviation': deviation_max,
+            'rooms_in_demand': rooms_in_demand,
+            'battery_alarms': battery_alarms,
+            'rf_alarms': rf_alarms,
+            'thermostats': count,
+        }
 
+    def device_by_id(self, id):
+        """Finds the device of a register id from the address scheme, or None"""
+        # U@Home: 0 - 59, controllers: 60 + 500 x c, thermostats: 80 + 500 x c + 40 x t
+        if id < 60:
+            return self.uhome
+        c = (id - 60) // 500
+        offset = id - 500 * c
+        if offset < 80:
+            return self._devices_by_index.get((c, None))
+        return self._devices_by_index.get((c, (offset - 80) // 40))
+
+    def value_by_id(self, id):
+        """Finds the value of a register id, or None"""
+        device = self.device_by_id(id)
+        if device is None:
+            return None
+        register = device.layout.by_addr.get(id - device.id_offset)
+        if register is None:
+            return None
+        return UponorValue(device, register)
+
+    def read_request(self, values):
         req = self.create_request("read")
         for value in values:
             obj = {'id': str(value.id), 'properties': {str(value.property): {}}}
             self.add_request_object(req, obj)
 
-        response_data = await self.do_rest_call(req)
+        return req
 
-        if self.validate_values(response_data, allvalue_dict):
-            for obj in response_data['result']['objects']:
-                try:
-                    data_id = int(obj['id'])
-                    value = value_dict[data_id]
-                    data_val = obj['properties'][value.property]['value']
-                except Exception as e:
-                    continue
+    def apply_response(self, values, response_data):
+        """Applies the response to a read request of values, except the values of the thermostats rejected by
+        rejected_devices(), which keep their last values. Values are decoded by the codec of their register in the
+        same pass, malformed values are dropped and keep their last value"""
+        value_dict = {}
+        for value in values:
+            value_dict[value.id] = value
+
+        if not isinstance(response_data, dict) or not isinstance(response_data.get('result'), dict) or \
+                not isinstance(response_data['result'].get('objects'), list):
+            raise UponorAPIException(f"Invalid API response: {str(response_data)[:200]}")
+
+        rejected = self.rejected_devices(response_data)
+        if rejected:
+            self.rejected_count += 1
+
+        now = time.monotonic()
+        for obj in response_data['result']['objects']:
+            try:
+                data_id = int(obj['id'])
+                value = value_dict[data_id]
+                data_val = obj['properties'][value.property]['value']
+            except Exception as e:
+                continue
+
+            if value.device in rejected:
+                continue
+
+            try:
+                data_val = value.register.codec.decode(data_val)
+            except (TypeError, ValueError) as e:
+                self.malformed_count += 1
+                _LOGGER.debug("Dropped malformed value of %s: %s", value.name, e)
+                continue
+
+            value.value = data_val
+            value.read_time = now
+            self.history.record(data_id, data_val, now)
 
-                value.value = data_val
+        # Only the thermostats showing the values of their neighbour count towards their quarantine
+        for device in {value.device for value in values}:
+            if device in rejected:
+                device.rejected_updates += 1
+            else:
+                device.rejected_updates = 0
 
     def getStepValue(self, id, therm):
         #Obtain addr of THERMOSTAT_KEY, thermostatindex and controllerindex
         #Obtain step jump between thermostats (40,80,..)
-        c=0
-        t=0
+        #Same address scheme as device_by_id(), the registers of thermostats 10 and 11 reach into the next 500 block
         step=0
-        for i in range(4):
-            if id > 500:
-                id=id-500
-                c=c+1
-        id=id-80
-        for i in range(9):
-            if id > 40:
-                id=id-40
-                t=t+1
-        data_addr=id, t, c
+        if id < 60:
+            return step
+        c = (id - 60) // 500
+        id = id - 500 * c - 80
+        if id < 0:
+            return step
+        data_addr = id % 40, id // 40, c
         if data_addr[0] in (11,25,28):
             nextt=0
             for t in therm:
@@ -233,42 +774,58 @@ class UponorClient(object):
                 step=(nextt[0]-data_addr[1])*40
         return step
 
-    def validate_values(self,response_data,allvalue_dict):
+    def validate_values(self,response_data):
+        """Whether a read response can be applied as a whole, see rejected_devices()"""
+        return not self.rejected_devices(response_data)
+
+    def rejected_devices(self,response_data):
 
         #Function to detect same values errors
         #api sometimes generate response errors that show values of the next thermostat
-        #this function evaluate response and detect if values are values of the next thermostat, in that case, values do not sets
-        samevalue = 0
+        #this function evaluate response and detect if values are values of the next thermostat, and returns the set of those
+        #thermostats, their values are not set
+        #the setpoint and the temperature come from the next thermostat together, so the response is rejected when all the
+        #checked values of a thermostat, at least two, look like the next thermostat's values and one of them changed.
+        #Not detected: the last thermostat of a controller, which has no next thermostat, the first read of a thermostat, and
+        #a thermostat split over two responses, which UponorShard.batches() avoids
+        samevalue = Counter()
+        checked = Counter()
+        changed = set()
         therm=[]
         for thermostat in self.thermostats:
             therm.append([thermostat.thermostat_index,thermostat.controller_index])
         for obj in response_data['result']['objects']:
             try:
                 data_id = int(obj['id'])
-                value = allvalue_dict[data_id]
+                value = self.value_by_id(data_id)
+                if value is None:
+                    continue
                 data_val = obj['properties'][value.property]['value']
                 step=self.getStepValue(data_id,therm)
                 #only is necesary validate values in addrs 11,25,28, rest of values do not change
                 if step != 0:
-                    if allvalue_dict[data_id]:
-                        oldvalue=allvalue_dict[data_id]
-                    if allvalue_dict[data_id+step]:
-                        nextvalue=allvalue_dict[data_id+step]
+                    oldvalue=value
+                    nextvalue=self.value_by_id(data_id+step)
+                    if nextvalue is not None:
+                        checked[value.device] += 1
+                        #unchanged values tell nothing, e.g. two rooms with the same setpoint and temperature
+                        if oldvalue.value != data_val:
+                            changed.add(value.device)
                         if nextvalue.value == data_val:
-                            samevalue=samevalue+1
+                            samevalue[value.device] += 1
                         else:
                             res=nextvalue.value-oldvalue.value
                             if res > 0:
                                 if res >= 1 and str(data_id)[len(str(data_id))-1:len(str(data_id))] != '8':
                                     res = res*3/4
                                     if data_val > oldvalue.value+res:
-                                        samevalue=samevalue+1
+                                        samevalue[value.device] += 1
                             else:
                                 res=res*-1
                                 if res >= 1 and str(data_id)[len(str(data_id))-1:len(str(data_id))] != '8':
                                     res = res*3/4
                                     if data_val < oldvalue.value-res:
-                                        samevalue=samevalue+1
+                                        samevalue[value.device] += 1
                     #_LOGGER.debug("Response values, id %d, value %s, samevalue %d, old %s, idnext %s, next %s",data_id,data_val,samevalue,oldvalue.value,data_id+step,nextvalue.value)
 
             except Exception as e:
@@ -276,14 +833,13 @@ class UponorClient(object):
                     _LOGGER.debug("Response error %s obj %s",e,obj)
                 continue
 
-        if samevalue == 3:
-            _LOGGER.warning("Response error in API, wrong value, not updated sensor")
+        rejected = {device for device, count in samevalue.items() if count >= 2 and count == checked[device] and device in changed}
+        if rejected:
+            _LOGGER.warning("Response error in API, wrong value, not updated sensor of %s", ", ".join(device.identity_string for device in rejected))
             _LOGGER.debug("Response error in API, same value in different thermostat not updated in this response API: %s ",response_data['result']['objects'])
-            return False
-        else:
-            return True
+        return rejected
 
-    async def set_values(self, *value_tuples):
+    async def set_values(self, *value_tuples, deadline=None):
         """Writes values to UHome, accepts tuples of (UponorValue, New Value)"""
         
         _LOGGER.debug("set_values: writing %d values: %s",
@@ -293,59 +849,432 @@ class UponorClient(object):
         req = self.create_request("write")
 
         for tpl in value_tuples:
-            obj = {'id': str(tpl[0].id), 'properties': {str(tpl[0].property): {'value': str(tpl[1])}}}
+            try:
+                encoded = tpl[0].register.codec.encode(tpl[1])
+            except (TypeError, ValueError) as ex:
+                raise UponorAPIException(f"Invalid value for {tpl[0].name}", ex) from ex
+            obj = {'id': str(tpl[0].id), 'properties': {str(tpl[0].property): {'value': encoded}}}
             self.add_request_object(req, obj)
 
-        response = await self.do_rest_call(req)
+        response = await self.do_rest_call(req, deadline)
         _LOGGER.debug("set_values: response: %s", response)
 
         # Apply new values, after the API call succeeds
         for tpl in value_tuples:
-            tpl[0].value = tpl[1]
+            tpl[0].value = tpl[0].register.codec.decode(tpl[1])
+        self.publish_states({tpl[0].device for tpl in value_tuples})
+        self.notify({tpl[0].device for tpl in value_tuples})
+
+        # Poll written devices soon, mode changes on the U@Home affect every thermostat
+        for device in {tpl[0].device for tpl in value_tuples}:
+            if device is self.uhome:
+                for thermostat in self.thermostats:
+                    thermostat.speed_up()
+            else:
+                device.speed_up()
+
+    async def set_setpoints(self, setpoints, hc_mode=None, forced_eco_mode=None):
+        """Writes the setpoints of several thermostats, and optionally the HC and eco modes, in a single request.
+        Accepts a dict of UponorThermostat to new setpoint"""
+        value_tuples = []
+
+        if hc_mode is not None:
+            value_tuples.append((self.uhome.by_name('allow_hc_mode_change'), 0))
+            value_tuples.append((self.uhome.by_name('hc_mode'), hc_mode))
+
+        if forced_eco_mode is not None:
+            value_tuples.append((self.uhome.by_name('forced_eco_mode'), forced_eco_mode))
+
+        for thermostat, temperature in setpoints.items():
+            value_tuples.append((thermostat.by_name('setpoint_write_enable'), 0))
+            value_tuples.append((thermostat.by_name('room_setpoint'), temperature))
+
+        if len(value_tuples) == 0:
+            return
 
-class UponorValue(object):
-    """Single value in the Uponor API"""
+        await self.set_values(*value_tuples)
+
+        # Read back the written devices on their next update
+        for thermostat in setpoints:
+            thermostat.last_update = None
+        if hc_mode is not None or forced_eco_mode is not None:
+            self.uhome.last_update = None
+
+class UponorShard(object):
+    """Update work of one controller and its thermostats, or of the U@Home itself. Each shard has its own single-flight
+    queue, lock, health, batch size and timeouts, so a degraded controller does not delay the rest of the house"""
+
+    def __init__(self, uponor_client, index):
+        self.uponor_client = uponor_client
+        # Controller index, None for the U@Home
+        self.index = index
+        self.lock = asyncio.Lock()
+
+        # Batch size and request timeout and retries, None uses the client settings
+        self.max_values_batch = None
+        self.timeout = None
+        self.retries = None
+
+        # Health: consecutive failed cycles, and while degraded the monotonic time of the next attempt
+        self.failures = 0
+        self.last_error = None
+        self.last_success = None
+        self.retry_at = None
+
+        # Single-flight: devices of the cycle running or queued, to the future of that cycle,
+        # and the next cycle as [future, devices, deadline], merged from all calls while a cycle runs
+        self.futures = {}
+        self.next_cycle = None
+        self.task = None
+
+    @property
+    def name(self):
+        return "U@Home" if self.index is None else f"controller {self.index}"
+
+    @property
+    def degraded(self):
+        return self.failures >= SHARD_DEGRADED_FAILURES
+
+    def batch_size(self):
+        return self.max_values_batch or self.uponor_client.max_values_batch
+
+    def request_settings(self):
+        """Returns (timeout, retries) of the requests of this shard, degraded shards fail fast"""
+        if self.degraded:
+            return SHARD_DEGRADED_TIMEOUT, 0
+        client = self.uponor_client
+        return self.timeout or client.timeout, client.retries if self.retries is None else self.retries
+
+    def queue_update(self, device, deadline):
+        """Adds a device to the next update cycle, and returns the future of that cycle.
+        Without a deadline the cycle gets CYCLE_TIMEOUT_SECONDS from its start"""
+        loop = asyncio.get_running_loop()
+        if self.next_cycle is None:
+            future = loop.create_future()
+            # Retrieve the exception, in case all callers were cancelled
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.next_cycle = [future, [], deadline]
+
+        # The merged cycle gets the most generous deadline of its callers, each caller only waits for its own, see wait_shard()
+        remaining = lambda d: CYCLE_TIMEOUT_SECONDS if d is None else d.remaining()
+        if remaining(deadline) > remaining(self.next_cycle[2]):
+            self.next_cycle[2] = deadline
+        self.next_cycle[1].append(device)
+        self.futures[device] = self.next_cycle[0]
+
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run_cycles())
+        return self.next_cycle[0]
+
+    async def run_cycles(self):
+        while self.next_cycle is not None:
+            future, devices, deadline = self.next_cycle
+            self.next_cycle = None
+            if deadline is None:
+                deadline = Deadline(CYCLE_TIMEOUT_SECONDS)
+            try:
+                await self.update_cycle(devices, deadline)
+            except asyncio.CancelledError:
+                self.release(future, devices)
+                future.cancel()
+                raise
+            except Exception as ex:
+                self.release(future, devices)
+                future.set_exception(ex)
+            else:
+                self.release(future, devices)
+                future.set_result(None)
+
+    def release(self, future, devices):
+        for device in devices:
+            if self.futures.get(device) is future:
+                del self.futures[device]
+
+    def check_backoff(self):
+        if self.retry_at is not None and time.monotonic() < self.retry_at:
+            raise UponorAPIException(f"The {self.name} is not responding, next attempt in {self.retry_at - time.monotonic():.0f}s",
+                                     self.last_error)
+
+    def retry_now(self):
+        """Lifts the backoff, the next cycle is attempted right away. A degraded shard stays degraded until it succeeds"""
+        self.retry_at = None
+
+    def record_success(self):
+        if self.degraded:
+            _LOGGER.info("The %s responds again", self.name)
+        self.failures = 0
+        self.retry_at = None
+        self.last_success = datetime.now()
+
+    def record_failure(self, ex):
+        self.failures += 1
+        self.last_error = ex
+        if self.degraded:
+            backoff = min(SHARD_MIN_BACKOFF_SECONDS * 2 ** (self.failures - SHARD_DEGRADED_FAILURES), SHARD_MAX_BACKOFF_SECONDS)
+            self.retry_at = time.monotonic() + backoff
+            if self.failures == SHARD_DEGRADED_FAILURES:
+                _LOGGER.warning("The %s failed %d updates in a row, isolating it: %s", self.name, self.failures, ex)
+
+    def batches(self, values):
+        """Splits values into batches of at most batch_size(), keeping the values of a device in one batch where they fit,
+        so validate_values() sees the setpoint and the temperature of a thermostat in the same response"""
+        size = self.batch_size()
+        batch = []
+        for device, device_values in itertools.groupby(values, key=lambda value: value.device):
+            device_values = list(device_values)
+            if batch and len(batch) + len(device_values) > size:
+                yield batch
+                batch = []
+            batch.extend(device_values)
+            # Only a device with more values than a batch is split
+            while len(batch) > size:
+                yield batch[:size]
+                batch = batch[size:]
+        if batch:
+            yield batch
+
+    async def read(self, values, deadline):
+        """Reads values in batches, with the request settings of this shard. Returns after each batch, as a generator"""
+        client = self.uponor_client
+        timeout, retries = self.request_settings()
+        # Several batches share one HTTP request, if the gateway accepts JSON-RPC batches
+        for value_lists in chunks(list(self.batches(values)), client.max_batch_calls):
+            responses = await client.do_batch_call([client.read_request(value_list) for value_list in value_lists],
+                                                   deadline=deadline, timeout=timeout, retries=retries)
+            for value_list, response_data in zip(value_lists, responses):
+                client.apply_response(value_list, response_data)
+                yield value_list
+
+    async def update_cycle(self, devices, deadline):
+        client = self.uponor_client
+        async with self.lock:
+            try:
+                self.check_backoff()
+            except UponorAPIException:
+                client.notify(devices, failed=True)
+                raise
+
+            # Filter devices to include devices if either:
+            # - Device has never been updated
+            # - Device was last updated its update interval ago
+            now = datetime.now()
+            devices_to_update = [device for device in devices if (not device.pending_update and device.is_update_due(now))]
+
+            if len(devices_to_update) == 0:
+                return
+
+            values = []
+            unread = {}
+            for device in devices_to_update:
+                device_values = device.poll_values()
+                values.extend(device_values)
+                unread[device] = len(device_values)
+                device.pending_update = True
+
+            completed = []
+            try:
+                # Update all values, but at most N at a time
+                async for value_list in self.read(values, deadline):
+                    for value in value_list:
+                        unread[value.device] -= 1
+                        if unread[value.device] == 0:
+                            completed.append(value.device)
+            except Exception as e:
+                if isinstance(e, UponorDeadlineException):
+                    _LOGGER.warning("Update cycle of the %s ran out of time, %d of %d devices updated", self.name, len(completed), len(devices_to_update))
+                elif not self.degraded:
+                    _LOGGER.exception(e)
+                for device in devices_to_update:
+                    device.pending_update = False
+                # Keep the partial results
+                client.complete_update(completed)
+                client.notify([device for device in devices_to_update if device not in completed], failed=True)
+                self.record_failure(e)
+                raise
+
+            self.record_success()
+            client.complete_update(devices_to_update)
+
+    async def update_extended(self, devices, deadline):
+        async with self.lock:
+            self.check_backoff()
+
+            values = []
+            for device in devices:
+                values.extend(device.by_name(name) for name in device.extended_requests)
+
+            try:
+                async for value_list in self.read(values, deadline):
+                    pass
+            except Exception as e:
+                self.record_failure(e)
+                raise
 
-    def __init__(self, id, name, prop):
-        self.id = id
-        self.name = name
-        self.value = 0
-        self.property = prop
+            self.record_success()
+            for device in devices:
+                device.extended_last_update = datetime.now()
+            self.uponor_client.notify(devices)
+
+class UponorValue(object):
+    """View of a single register value of a device, backed by the client value store"""
+
+    __slots__ = ('device', 'register')
+
+    def __init__(self, device, register):
+        self.device = device
+        self.register = register
+
+    @property
+    def id(self):
+        return self.device.id_offset + self.register.addr
+
+    @property
+    def name(self):
+        return self.register.name
+
+    @property
+    def value(self):
+        return self.device.store.values[self.device.base + self.register.slot]
+
+    @value.setter
+    def value(self, value):
+        slot = self.device.base + self.register.slot
+        self.device.store.values[slot] = value
+        # Ranges are checked once, when the value is stored
+        self.device.store.in_range[slot] = self.register.codec.in_range(value)
+
+    @property
+    def read_time(self):
+        """Monotonic time of the last read from the gateway, None before the first"""
+        return self.device.store.times[self.device.base + self.register.slot]
+
+    @read_time.setter
+    def read_time(self, read_time):
+        self.device.store.times[self.device.base + self.register.slot] = read_time
+
+    def age(self, now=None):
+        """Seconds since the last read, None before the first"""
+        read_time = self.read_time
+        if read_time is None:
+            return None
+        return (now or time.monotonic()) - read_time
+
+    def is_stale(self, now=None):
+        """Past its hard TTL, or never read"""
+        age = self.age(now)
+        return age is None or age > self.register.stale_after
+
+    # Defined last, it shadows the property builtin in the class body
+    @property
+    def property(self):
+        return self.register.property
 
 class UponorBaseDevice(ABC):
-    """Base device class"""
+    """Base device class. A device is an id offset plus a block of the client value store, laid out by its RegisterLayout"""
 
-    def __init__(self, uponor_client, id_offset, properties, identity_string):
+    def __init__(self, uponor_client, id_offset, layout, identity_string):
         self.uponor_client = uponor_client
+        self.store = uponor_client.store
         self.id_offset = id_offset
-        self.properties_byname = {}
-        self.properties_byid = {}
-        self.properties = properties
+        self.layout = layout
+        self.base = self.store.allocate(layout)
         self.last_update = None
         self.pending_update = False
+        # Values come from a snapshot, see UponorClient.restore()
+        self.restored = False
+        # Values at the last notification of listeners, see UponorClient.notify()
+        self.notified_values = None
         self.identity_string = identity_string
+        # None uses the client max_update_interval, adaptive devices set their own
+        self.update_interval = None
+
+        # Extended registers are only polled while requested, see request_extended()
+        self.extended_requests = {}
+        self.extended_last_update = None
+
+        # Responses rejected by rejected_devices() in a row, and whether the device is only probed, see UponorThermostat
+        self.rejected_updates = 0
+        self.quarantined = False
+
+    def values(self, poll=POLL_CORE):
+        """Returns the values of all registers of a poll class"""
+        registers = self.layout.core if poll == POLL_CORE else self.layout.extended
+        return [UponorValue(self, register) for register in registers]
+
+    def poll_values(self):
+        """Returns the values read by an update cycle"""
+        return self.values()
 
-        for key_name, key_data in properties.items():
-            value = UponorValue(id_offset + key_data['addr'], key_name, key_data['property'])
-            self.properties_byid[value.id] = value
-            self.properties_byname[value.name] = value
-    
     def by_id(self, id):
-        return self.properties_byid[id]
+        return UponorValue(self, self.layout.by_addr[id - self.id_offset])
 
     def by_name(self, name):
-        return self.properties_byname[name]
+        return UponorValue(self, self.layout.by_name[name])
+
+    def get(self, name):
+        """Returns the cached value of a register, never waiting for the gateway. Past its soft TTL, the poll interval
+        of the register, a background refresh is started and the cached value is served meanwhile"""
+        value = self.by_name(name)
+        age = value.age()
+        if age is not None and age > self.poll_interval(value.register.poll).total_seconds():
+            self.uponor_client.refresh_in_background(self, value.register.poll == POLL_EXTENDED)
+        return value.value
+
+    def is_stale(self, *names):
+        """Whether any of the registers given, by default the core registers, is past its hard TTL"""
+        now = time.monotonic()
+        registers = [self.layout.by_name[name] for name in names] if names else self.layout.core
+        return any(UponorValue(self, register).is_stale(now) for register in registers)
+
+    def history(self, name):
+        """Returns the ring buffer with recent samples of a register"""
+        return self.uponor_client.history.buffer(self.by_name(name).id)
+
+    def request_extended(self, *names):
+        """Starts polling the extended registers given, until released again"""
+        for name in names:
+            if self.layout.by_name[name].poll != POLL_EXTENDED:
+                raise KeyError(name)
+            self.extended_requests[name] = self.extended_requests.get(name, 0) + 1
+
+        # Read the new registers on the next extended update
+        self.extended_last_update = None
+
+    def release_extended(self, *names):
+        """Stops polling the extended registers given, once no one else requests them"""
+        for name in names:
+            count = self.extended_requests.get(name, 0) - 1
+            if count > 0:
+                self.extended_requests[name] = count
+            else:
+                self.extended_requests.pop(name, None)
+
+    async def async_update(self, deadline=None):
+        #_LOGGER.debug("Updating %s, device '%s'", self.__class__.__name__, self.identity_string)
 
-    def attributes(self):
-        attr = None
-        for key_name, key_data in self.properties.items():
-            attr = str(attr) + str(key_name) + ': ' + str(self.properties_byname[key_name].value) + '#'
-        return attr
+        await self.uponor_client.update_devices(self, deadline=deadline)
 
-    async def async_update(self):
-        #_LOGGER.debug("Updating %s, device '%s'", self.__class__.__name__, self.identity_string)
+    def poll_interval(self, poll=POLL_CORE):
+        """Interval between reads of the registers of a poll class"""
+        if poll == POLL_EXTENDED:
+            return self.uponor_client.extended_update_interval
+        interval = self.update_interval
+        if interval is None or not self.uponor_client.adaptive_polling:
+            interval = self.uponor_client.max_update_interval
+        return interval
+
+    def is_update_due(self, now):
+        if self.last_update is None:
+            return True
+        return (now - self.last_update) > self.poll_interval()
 
-        await self.uponor_client.update_devices(self)
+    def speed_up(self):
+        """Called when the device is expected to change, e.g. after a write"""
+        pass
+
+    def sample(self, timestamp):
+        """Called with the poll time after every successful update of the device"""
+        pass
 
     @abstractmethod
     def is_valid(self):
@@ -355,7 +1284,18 @@ class UponorUhome(UponorBaseDevice):
     """U@Home API device class, typically an R-167"""
     
     def __init__(self, uponor_client):
-        super().__init__(uponor_client, 0, UHOME_MODULE_KEYS, "U@Home")
+        super().__init__(uponor_client, 0, UHOME_LAYOUT, "U@Home")
+        self.key = "uhome"
+        self.shard_index = None
+        self.last_modes = None
+
+    def sample(self, timestamp):
+        # A mode change, e.g. from the app, changes the demand of every room
+        modes = (self.by_name('hc_mode').value, self.by_name('forced_eco_mode').value)
+        if self.last_modes is not None and modes != self.last_modes:
+            for thermostat in self.uponor_client.thermostats:
+                thermostat.speed_up()
+        self.last_modes = modes
 
     def is_valid(self):
         return True
@@ -365,9 +1305,16 @@ class UponorController(UponorBaseDevice):
     
     def __init__(self, uponor_client, controller_index):
         # Offset: 60 + 500 x c
-        super().__init__(uponor_client, 60 + 500 * controller_index, UHOME_CONTROLLER_KEYS, str(controller_index))
+        super().__init__(uponor_client, 60 + 500 * controller_index, CONTROLLER_LAYOUT, str(controller_index))
 
         self.controller_index = controller_index
+        self.key = f"c{controller_index}"
+        self.shard_index = controller_index
+
+        # Demand of the controller: on while any of its rooms is in demand.
+        # rooms_in_demand is kept up to date by the thermostats, see UponorThermostat.sample()
+        self.rooms_in_demand = 0
+        self.demand = DutyCycle()
 
     def is_valid(self):
         return True
@@ -377,14 +1324,146 @@ class UponorThermostat(UponorBaseDevice):
     
     def __init__(self, uponor_client, controller_index, thermostat_index):
         # Offset: 80 + 500 x c + 40 x t
-        super().__init__(uponor_client, 80 + 500 * controller_index + 40 * thermostat_index, UHOME_THERMOSTAT_KEYS, f"{controller_index} / {thermostat_index}")
+        super().__init__(uponor_client, 80 + 500 * controller_index + 40 * thermostat_index, THERMOSTAT_LAYOUT, f"{controller_index} / {thermostat_index}")
         self.controller_index = controller_index
         self.thermostat_index = thermostat_index
+        self.key = f"c{controller_index}t{thermostat_index}"
+        self.shard_index = controller_index
+        self.in_demand = False
+        self.demand = DutyCycle()
+        # (room_temperature, room_setpoint, room_in_demand) at the last poll, for adaptive polling
+        self.last_state = None
+        # Updates in a row that failed is_valid(), see quarantine()
+        self.invalid_updates = 0
+        # ThermostatState of the last update, see publish_state()
+        self.state = None
+
+    @property
+    def controller(self):
+        for controller in self.uponor_client.controllers:
+            if controller.controller_index == self.controller_index:
+                return controller
+        return None
+
+    def publish_state(self):
+        """Replaces state with a ThermostatState of the current values, read in one go so it reflects a single update"""
+        uhome = self.uponor_client.uhome
+        read_times = [value.read_time for value in self.values()]
+        stale_at = None
+        if None not in read_times:
+            stale_at = min(read_time + register.stale_after for read_time, register in zip(read_times, self.layout.core))
+
+        self.state = ThermostatState(
+            room_name=self.by_name('room_name').value,
+            room_temperature=self.by_name('room_temperature').value,
+            room_setpoint=self.by_name('room_setpoint').value,
+            rh_value=self.by_name('rh_value').value,
+            in_demand=self.by_name('room_in_demand').value != 0,
+            cooling=uhome.by_name('hc_mode').value == UHOME_MODE_COOL,
+            forced_eco=uhome.by_name('forced_eco_mode').value == UHOME_MODE_ECO,
+            alarms=MappingProxyType({
+                'technical_alarm': self.by_name('technical_alarm').value,
+                'rf_alarm': self.by_name('rf_alarm').value,
+                'battery_alarm': self.by_name('battery_alarm').value,
+                'remote_access_alarm': uhome.by_name('remote_access_alarm').value,
+                'device_lost_alarm': uhome.by_name('device_lost_alarm').value,
+            }),
+            valid=self.is_valid(),
+            restored=self.restored,
+            stale_at=stale_at,
+        )
+
+    def poll_values(self):
+        if self.quarantined:
+            return [self.by_name(name) for name in QUARANTINE_PROBE_REGISTERS]
+        return self.values()
+
+    def poll_interval(self, poll=POLL_CORE):
+        if self.quarantined and poll == POLL_CORE:
+            return QUARANTINE_PROBE_INTERVAL
+        return super().poll_interval(poll)
+
+    def quarantine(self):
+        """Only probes the thermostat from now on, at a lower rate and with a few registers, until it is valid again"""
+        _LOGGER.warning("Thermostat %s keeps reporting invalid values, probing it every %s until it recovers",
+                        self.identity_string, QUARANTINE_PROBE_INTERVAL)
+        self.quarantined = True
+        self.last_state = None
+        # Nothing is known about the room until it recovers, it must not keep the controller demand on
+        if self.in_demand:
+            self.in_demand = False
+            controller = self.controller
+            if controller:
+                controller.rooms_in_demand -= 1
+                controller.demand.sample(controller.rooms_in_demand > 0)
+
+    def release(self):
+        """Brings a quarantined thermostat back to normal polling, with a full read on the next update"""
+        _LOGGER.info("Thermostat %s reports valid values again, back to normal polling", self.identity_string)
+        self.quarantined = False
+        self.invalid_updates = 0
+        self.rejected_updates = 0
+        self.last_update = None
+        self.update_interval = self.uponor_client.update_interval_floor
+
+    def sample(self, timestamp):
+        self.invalid_updates = 0 if self.is_valid() else self.invalid_updates + 1
+        if self.quarantined:
+            # Probes only read a few registers, the duty cycles and the poll interval wait for a full read.
+            # A rejected probe keeps the old values, they must not release the thermostat
+            if self.invalid_updates == 0 and self.rejected_updates == 0:
+                self.release()
+            return
+        if self.invalid_updates >= QUARANTINE_INVALID_UPDATES or self.rejected_updates >= QUARANTINE_REJECTED_UPDATES:
+            self.quarantine()
+            return
+
+        # Feed the room and controller duty cycles, O(1) per sample
+        in_demand = self.by_name('room_in_demand').value != 0
+        controller = self.controller
+
+        if in_demand != self.in_demand:
+            self.in_demand = in_demand
+            if controller:
+                controller.rooms_in_demand += 1 if in_demand else -1
+
+        self.demand.sample(in_demand, timestamp)
+        if controller:
+            controller.demand.sample(controller.rooms_in_demand > 0, timestamp)
+
+        self.adapt_update_interval()
+
+    def speed_up(self):
+        self.update_interval = self.uponor_client.update_interval_floor
+
+    def adapt_update_interval(self):
+        """Shortens the update interval while the room is changing, and lengthens it while stable"""
+        client = self.uponor_client
+        state = (self.by_name('room_temperature').value, self.by_name('room_setpoint').value, self.by_name('room_in_demand').value)
+        last_state = self.last_state
+        self.last_state = state
+
+        if last_state is None:
+            return
+
+        rate = self.history('room_temperature').rate_of_change(ADAPTIVE_RATE_WINDOW)
+        changing = state[1:] != last_state[1:] or \
+                   abs(state[0] - last_state[0]) >= ADAPTIVE_TEMPERATURE_STEP or \
+                   (rate is not None and abs(rate) >= ADAPTIVE_TEMPERATURE_RATE)
+
+        if changing:
+            self.update_interval = client.update_interval_floor
+        else:
+            interval = self.update_interval or client.max_update_interval
+            self.update_interval = min(interval * ADAPTIVE_BACKOFF, client.update_interval_ceiling)
+        self.update_interval = max(self.update_interval, client.update_interval_floor)
 
     def is_valid(self):
-        # A Thermostat is valid if the temperature is -40<=T<=100 C* and the setpoint is 5<=S<=35 C*
-        return -40 <= self.by_name('room_temperature').value and self.by_name('room_temperature').value <= 100 and \
-               1 <= self.by_name('room_setpoint').value and self.by_name('room_setpoint').value <= 40
+        # A Thermostat is valid if the temperature and the setpoint are within the min and max of their registers,
+        # -40<=T<=100 C* and 1<=S<=40 C*, as checked when they were stored
+        in_range = self.store.in_range
+        return in_range[self.base + THERMOSTAT_LAYOUT.by_name['room_temperature'].slot] and \
+               in_range[self.base + THERMOSTAT_LAYOUT.by_name['room_setpoint'].slot]
 
     async def set_name(self, name):
         """Updates the thermostats room name to a new value"""
@@ -0,0 +1,5 @@
+"""Allows running the API client as python -m uponor_api"""
+
+from .cli import main
+
+main()
@@ -0,0 +1,243 @@
+"""Command line interface for the UHome Uponor API client
+
+Run from the custom_components/uhomeuponor directory, only aiohttp is needed:
+
+    python -m uponor_api 192.168.1.10 rescan
+    python -m uponor_api 192.168.1.10 dump --extended
+    python -m uponor_api 192.168.1.10 watch --interval 10
+    python -m uponor_api 192.168.1.10 write c0t3 room_setpoint 21.5
+    python -m uponor_api 192.168.1.10 bench --cycles 20
+    python -m uponor_api 192.168.1.0/24 discover
+    python -m uponor_api 192.168.1.10 tune --output uhomeuponor_tuning.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from datetime import timedelta
+
+import aiohttp
+
+from . import UponorClient, UponorAPIException
+from .registers import POLL_EXTENDED
+from .discovery import DISCOVERY_CONCURRENCY, DISCOVERY_TIMEOUT_SECONDS, discover, network_hosts
+from .profiler import DEFAULT_BATCHES, DEFAULT_BATCH_CALLS, DEFAULT_CONCURRENCY, DEFAULT_TIMEOUTS, TUNING_FILE, percentile, sweep, recommend, save_tuning
+
+def devices(client):
+    return [client.uhome] + client.controllers + client.thermostats
+
+def device_key(device):
+    """Short device name used on the command line: uhome, c0 or c0t3"""
+    return device.key
+
+def find_device(client, key):
+    for device in devices(client):
+        if device_key(device) == key:
+            return device
+    raise SystemExit(f"Unknown device '{key}', expected one of: {', '.join(device_key(d) for d in devices(client))}")
+
+def parse_value(text):
+    """Numbers are written as numbers, anything else as text"""
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+def force_refresh(client):
+    # Make every update_devices() call go to the gateway
+    client.adaptive_polling = False
+    client.max_update_interval = timedelta(0)
+    client.extended_update_interval = timedelta(0)
+
+def device_values(device, extended=False):
+    values = device.values()
+    if extended:
+        values.extend(device.values(POLL_EXTENDED))
+    return values
+
+async def command_rescan(client, args):
+    start = time.perf_counter()
+    await client.rescan()
+    elapsed = time.perf_counter() - start
+
+    print(f"module_id {client.uhome.by_name('module_id').value}, {len(client.controllers)} controllers, "
+          f"{len(client.thermostats)} thermostats, {client.request_count} requests in {elapsed:.2f}s")
+    for thermostat in client.thermostats:
+        print(f"  {device_key(thermostat):6} {str(thermostat.by_name('room_name').value):20} "
+              f"{thermostat.by_name('room_temperature').value:>6} / {thermostat.by_name('room_setpoint').value:<6}"
+              f"{'' if thermostat.is_valid() else ' (invalid)'}")
+
+async def command_dump(client, args):
+    await client.rescan()
+    if args.extended:
+        force_refresh(client)
+        for thermostat in client.thermostats:
+            thermostat.request_extended(*(register.name for register in thermostat.layout.extended))
+        await client.update_extended(client.thermostats)
+
+    if args.json:
+        output = {device_key(device): {value.name: {'id': value.id, 'value': value.value}
+                                       for value in device_values(device, args.extended)}
+                  for device in devices(client)}
+        print(json.dumps(output, indent=2))
+        return
+
+    for device in devices(client):
+        print(f"{device_key(device)} ({device.__class__.__name__} {device.identity_string})")
+        for value in device_values(device, args.extended):
+            print(f"  {value.id:5} {value.name:32} {value.value}")
+
+async def command_watch(client, args):
+    await client.rescan()
+    force_refresh(client)
+
+    last = {value.id: value.value for device in devices(client) for value in device_values(device)}
+    while True:
+        await asyncio.sleep(args.interval)
+        try:
+            await client.update_devices(devices(client))
+        except UponorAPIException as ex:
+            print(f"{time.strftime('%H:%M:%S')} update failed: {ex}")
+            continue
+
+        for device in devices(client):
+            for value in device_values(device):
+                if last.get(value.id) != value.value:
+                    print(f"{time.strftime('%H:%M:%S')} {device_key(device):6} {value.name:32} {last.get(value.id)} -> {value.value}")
+                    last[value.id] = value.value
+
+async def command_write(client, args):
+    await client.rescan()
+    device = find_device(client, args.device)
+    value = device.by_name(args.name)
+    new_value = parse_value(args.value)
+
+    start = time.perf_counter()
+    await client.set_values((value, new_value))
+    print(f"{device_key(device)} {value.name} (id {value.id}) set to {new_value} in {time.perf_counter() - start:.2f}s")
+
+async def command_bench(client, args):
+    await client.rescan()
+    force_refresh(client)
+
+    timings = []
+    failures = 0
+    requests = client.request_count
+    for _ in range(args.cycles):
+        start = time.perf_counter()
+        try:
+            await client.update_devices(devices(client))
+            timings.append(time.perf_counter() - start)
+        except UponorAPIException:
+            failures += 1
+
+    requests = client.request_count - requests
+    print(f"{args.cycles} cycles of {sum(len(device_values(d)) for d in devices(client))} values, "
+          f"{failures} failed, {requests} requests")
+    if timings:
+        print(f"min {min(timings):.3f}s  mean {sum(timings) / len(timings):.3f}s  p50 {percentile(timings, 50):.3f}s  "
+              f"p95 {percentile(timings, 95):.3f}s  max {max(timings):.3f}s")
+
+async def command_discover(client, args):
+    # The host argument is a network, or a comma separated list of hosts, e.g. 127.0.0.1:8080,127.0.0.1:8081
+    try:
+        hosts = network_hosts(args.host) if '/' in args.host else args.host.split(',')
+    except ValueError as ex:
+        raise SystemExit(f"Error: {ex}")
+
+    start = time.perf_counter()
+    gateways = await discover(client.session, hosts, args.concurrency, args.timeout)
+    print(f"Probed {len(hosts)} hosts in {time.perf_counter() - start:.2f}s, found {len(gateways)} U@Home gateways")
+    for gateway in gateways:
+        print(f"  {gateway.host:21} module_id {gateway.module_id}, controllers {gateway.controllers}")
+
+def parse_list(text, kind):
+    return [kind(item) for item in text.split(',') if item]
+
+async def command_tune(client, args):
+    await client.rescan()
+
+    print(f"{'batch':>5} {'calls':>5} {'conc':>4} {'timeout':>7} {'requests':>8} {'values/s':>9} {'p50':>7} {'p95':>7} {'p99':>7} {'errors':>7} {'rejected':>8}")
+
+    def progress(result):
+        print(f"{result.max_values_batch:5} {result.max_batch_calls:5} {result.concurrency:4} {result.timeout:7} {result.requests:8} "
+              f"{result.values_per_second:9.1f} {result.p50 or 0:7.3f} {result.p95 or 0:7.3f} {result.p99 or 0:7.3f} "
+              f"{result.error_rate:7.1%} {result.rejection_rate:8.1%}")
+
+    results = await sweep(client, parse_list(args.batches, int), parse_list(args.concurrency, int),
+                          parse_list(args.timeouts, float), args.cycles, progress, parse_list(args.batch_calls, int))
+    tuning = recommend(results, client.server)
+    print(f"Recommended: max_values_batch {tuning['max_values_batch']}, max_batch_calls {tuning['max_batch_calls']}, "
+          f"max_concurrent_requests {tuning['max_concurrent_requests']}, "
+          f"timeout {tuning['timeout']}s, retries {tuning['retries']}")
+
+    save_tuning(args.output, tuning)
+    print(f"Saved to {args.output}, copy it to the Home Assistant configuration directory")
+
+COMMANDS = {
+    'rescan': command_rescan,
+    'dump': command_dump,
+    'watch': command_watch,
+    'write': command_write,
+    'bench': command_bench,
+    'discover': command_discover,
+    'tune': command_tune,
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="uponor_api", description="Uponor U@Home (R-167) command line client")
+    parser.add_argument('host', help="Host or IP address of the U@Home gateway, discover: network or hosts to probe")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Enable debug logging")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('rescan', help="Discover controllers and thermostats")
+
+    dump = commands.add_parser('dump', help="Read and print every register")
+    dump.add_argument('--extended', action='store_true', help="Include the extended thermostat registers")
+    dump.add_argument('--json', action='store_true', help="Print JSON")
+
+    watch = commands.add_parser('watch', help="Poll continuously and print changed values")
+    watch.add_argument('--interval', type=float, default=30, help="Seconds between polls (default 30)")
+
+    write = commands.add_parser('write', help="Write a register value")
+    write.add_argument('device', help="uhome, c<controller> or c<controller>t<thermostat>, e.g. c0t3")
+    write.add_argument('name', help="Register name, e.g. room_setpoint")
+    write.add_argument('value', help="New value")
+
+    bench = commands.add_parser('bench', help="Time full poll cycles")
+    bench.add_argument('--cycles', type=int, default=10, help="Number of poll cycles (default 10)")
+
+    discover = commands.add_parser('discover', help="Find U@Home gateways in a network, e.g. 192.168.1.0/24")
+    discover.add_argument('--concurrency', type=int, default=DISCOVERY_CONCURRENCY,
+                          help=f"Requests in flight (default {DISCOVERY_CONCURRENCY})")
+    discover.add_argument('--timeout', type=float, default=DISCOVERY_TIMEOUT_SECONDS,
+                          help=f"Seconds per host (default {DISCOVERY_TIMEOUT_SECONDS})")
+
+    tune = commands.add_parser('tune', help="Sweep batch size, calls per request, concurrency and timeout, and save the recommended settings")
+    tune.add_argument('--cycles', type=int, default=5, help="Poll cycles per combination (default 5)")
+    tune.add_argument('--batches', default=','.join(map(str, DEFAULT_BATCHES)), help="Comma separated max_values_batch values")
+    tune.add_argument('--batch-calls', default=','.join(map(str, DEFAULT_BATCH_CALLS)), help="Comma separated max_batch_calls values")
+    tune.add_argument('--concurrency', default=','.join(map(str, DEFAULT_CONCURRENCY)), help="Comma separated requests in flight")
+    tune.add_argument('--timeouts', default=','.join(map(str, DEFAULT_TIMEOUTS)), help="Comma separated request timeouts in seconds")
+    tune.add_argument('--output', default=TUNING_FILE, help=f"File to write (default {TUNING_FILE})")
+
+    return parser
+
+async def run(args):
+    async with aiohttp.ClientSession() as session:
+        client = UponorClient(None, args.host, session)
+        await COMMANDS[args.command](client, args)
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    except UponorAPIException as ex:
+        raise SystemExit(f"Error: {ex}")
@@ -0,0 +1,130 @@
+"""Typed decoding and encoding of register values, driven by the register tables in const.py
+
+A table entry selects its codec with 'type', the default is 'raw':
+
+- raw: the JSON value as is
+- float: a number, e.g. a temperature, optionally limited by 'min' and 'max'
+- int: a whole number, optionally limited by 'min' and 'max'
+- bool: 0 or 1 flags such as alarms, any other number is true
+- enum: a whole number out of 'choices'
+- bitmask: a whole number of 'bits' bits, e.g. the controller and thermostat presence
+- string: text, e.g. the room name
+
+decode() raises ValueError or TypeError for malformed values, which are dropped when a response is applied.
+Values outside of 'min' and 'max' are kept, they are how the gateway reports a missing sensor, but in_range() is false.
+"""
+
+import math
+
+class RawCodec(object):
+    """Passes values through, writes them as text"""
+
+    type = 'raw'
+
+    def __init__(self, data):
+        pass
+
+    def decode(self, value):
+        return value
+
+    def encode(self, value):
+        return str(value)
+
+    def in_range(self, value):
+        return True
+
+class FloatCodec(RawCodec):
+
+    type = 'float'
+
+    def __init__(self, data):
+        self.minimum = data.get('min')
+        self.maximum = data.get('max')
+
+    def decode(self, value):
+        # JSON true and false are not numbers here
+        if isinstance(value, bool):
+            raise TypeError(f"Expected a number, got {value!r}")
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f"Expected a finite number, got {value!r}")
+        return value
+
+    def encode(self, value):
+        value = self.decode(value)
+        if not self.in_range(value):
+            raise ValueError(f"{value} is outside of {self.minimum}..{self.maximum}")
+        return str(value)
+
+    def in_range(self, value):
+        if not isinstance(value, (int, float)):
+            return False
+        return (self.minimum is None or value >= self.minimum) and (self.maximum is None or value <= self.maximum)
+
+class IntCodec(FloatCodec):
+
+    type = 'int'
+
+    def decode(self, value):
+        number = super().decode(value)
+        if not number.is_integer():
+            raise ValueError(f"Expected a whole number, got {value!r}")
+        return int(number)
+
+class BoolCodec(IntCodec):
+
+    type = 'bool'
+
+    def decode(self, value):
+        if isinstance(value, bool):
+            return value
+        return super().decode(value) != 0
+
+    def encode(self, value):
+        return "1" if self.decode(value) else "0"
+
+    def in_range(self, value):
+        return True
+
+class EnumCodec(IntCodec):
+
+    type = 'enum'
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.choices = frozenset(data['choices'])
+
+    def decode(self, value):
+        value = super().decode(value)
+        if value not in self.choices:
+            raise ValueError(f"Expected one of {sorted(self.choices)}, got {value!r}")
+        return value
+
+class BitmaskCodec(IntCodec):
+
+    type = 'bitmask'
+
+    def __init__(self, data):
+        data = dict(data, min=0, max=(1 << data['bits']) - 1)
+        super().__init__(data)
+
+    def decode(self, value):
+        value = super().decode(value)
+        if not self.in_range(value):
+            raise ValueError(f"Expected a mask of {self.maximum.bit_length()} bits, got {value!r}")
+        return value
+
+class StringCodec(RawCodec):
+
+    type = 'string'
+
+    def decode(self, value):
+        if value is None or isinstance(value, (bool, dict, list)):
+            raise TypeError(f"Expected text, got {value!r}")
+        return str(value)
+
+CODECS = {codec.type: codec for codec in (RawCodec, FloatCodec, IntCodec, BoolCodec, EnumCodec, BitmaskCodec, StringCodec)}
+
+def codec(data):
+    """Returns the codec of a register table entry"""
+    return CODECS[data.get('type', 'raw')](data)
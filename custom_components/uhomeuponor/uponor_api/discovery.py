@@ -0,0 +1,89 @@
+"""Discovery of U@Home gateways on the local network
+
+Probes every host of a network concurrently, with a bounded number of requests in flight and a short timeout per
+host. A host is a U@Home gateway if it answers a JSON-RPC read of module_id and controller_presence.
+"""
+
+import asyncio
+import ipaddress
+import json
+import logging
+from collections import namedtuple
+
+import aiohttp
+
+from .registers import UHOME_LAYOUT
+
+_LOGGER = logging.getLogger(__name__)
+
+DISCOVERY_CONCURRENCY = 64
+DISCOVERY_TIMEOUT_SECONDS = 1.5
+# Larger networks take minutes even with many requests in flight
+DISCOVERY_MAX_HOSTS = 1024
+
+# controllers: indexes of the controllers present, from controller_presence
+Gateway = namedtuple('Gateway', ['host', 'module_id', 'controllers'])
+
+PROBE_REGISTERS = ('module_id', 'controller_presence')
+
+def network_hosts(network):
+    """Returns the host addresses of a network, e.g. '192.168.1.0/24'"""
+    network = ipaddress.ip_network(network, strict=False)
+    if network.num_addresses > DISCOVERY_MAX_HOSTS + 2:
+        raise ValueError(f"Network {network} is too large to probe, at most {DISCOVERY_MAX_HOSTS} hosts")
+    return [str(host) for host in network.hosts()]
+
+def probe_request():
+    registers = [UHOME_LAYOUT.by_name[name] for name in PROBE_REGISTERS]
+    return {
+        'jsonrpc': "2.0",
+        'id': 1,
+        'method': 'read',
+        'params': {
+            'objects': [{'id': str(register.addr), 'properties': {register.property: {}}} for register in registers]
+        }
+    }
+
+def parse_probe_response(host, response_data):
+    """Returns a Gateway if the response is a U@Home read response, else None"""
+    try:
+        values = {}
+        for obj in response_data['result']['objects']:
+            values[int(obj['id'])] = next(iter(obj['properties'].values()))['value']
+        module_id = values[UHOME_LAYOUT.by_name['module_id'].addr]
+        presence = int(values[UHOME_LAYOUT.by_name['controller_presence'].addr])
+    except (KeyError, TypeError, ValueError, AttributeError, StopIteration):
+        return None
+
+    return Gateway(host, module_id, [i for i in range(0, 4) if presence & (1 << i)])
+
+async def probe(session, host, timeout=DISCOVERY_TIMEOUT_SECONDS):
+    """Probes a host, or host:port, returns a Gateway or None"""
+    try:
+        async with session.post(
+            f"http://{host}/api",
+            data=json.dumps(probe_request()),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            if response.status != 200:
+                return None
+            return parse_probe_response(host, json.loads(await response.text()))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, OSError):
+        return None
+
+async def discover(session, hosts, concurrency=DISCOVERY_CONCURRENCY, timeout=DISCOVERY_TIMEOUT_SECONDS):
+    """Probes hosts concurrently, with at most concurrency requests in flight. Returns the Gateways found, in host order"""
+    hosts = list(hosts)
+    results = [None] * len(hosts)
+    pending = iter(range(len(hosts)))
+
+    async def worker():
+        # Workers share the iterator, so only concurrency probes exist at any time
+        for i in pending:
+            results[i] = await probe(session, hosts[i], timeout)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(hosts)))))
+
+    gateways = [gateway for gateway in results if gateway is not None]
+    _LOGGER.debug("Probed %d hosts, found %d U@Home gateways", len(hosts), len(gateways))
+    return gateways
@@ -0,0 +1,220 @@
+"""In-memory history of recent register values"""
+
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress, repeat
+from operator import mul, sub
+
+class RingBuffer(object):
+    """Fixed-size ring buffer of (timestamp, value) samples, stored in two compact double arrays.
+    Timestamps are time.monotonic() seconds. Queries take an optional window in seconds, counted back from now"""
+
+    def __init__(self, size):
+        self.size = size
+        self.timestamps = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.count = 0
+        # Next write position, also the oldest sample once the buffer is full
+        self.head = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def last(self):
+        """Returns the newest (timestamp, value) sample, or None"""
+        if self.count == 0:
+            return None
+        i = (self.head - 1) % self.size
+        return self.timestamps[i], self.values[i]
+
+    def _ordered(self, arr):
+        if self.count < self.size:
+            return arr[:self.count]
+        return arr[self.head:] + arr[:self.head]
+
+    def window(self, seconds=None, now=None):
+        """Returns (timestamps, values) arrays, oldest first, of the samples in the window"""
+        timestamps = self._ordered(self.timestamps)
+        values = self._ordered(self.values)
+
+        if seconds is None:
+            return timestamps, values
+
+        if now is None:
+            now = time.monotonic()
+        start = bisect_left(timestamps, now - seconds)
+        return timestamps[start:], values[start:]
+
+    def minimum(self, seconds=None, now=None):
+        _, values = self.window(seconds, now)
+        return min(values) if values else None
+
+    def maximum(self, seconds=None, now=None):
+        _, values = self.window(seconds, now)
+        return max(values) if values else None
+
+    def mean(self, seconds=None, now=None):
+        _, values = self.window(seconds, now)
+        return sum(values) / len(values) if values else None
+
+    def rate_of_change(self, seconds=None, now=None):
+        """Least-squares slope of the samples in the window, in units per hour"""
+        timestamps, values = self.window(seconds, now)
+        n = len(values)
+        if n < 2:
+            return None
+
+        # Shift timestamps to the first sample, to keep the sums well-conditioned
+        t = array('d', map(sub, timestamps, repeat(timestamps[0], n)))
+        sum_t = sum(t)
+        sum_v = sum(values)
+        denominator = n * sum(map(mul, t, t)) - sum_t * sum_t
+        if denominator == 0:
+            return None
+
+        return (n * sum(map(mul, t, values)) - sum_t * sum_v) / denominator * 3600
+
+    def time_true(self, seconds=None, now=None):
+        """Seconds within the window during which the value was non-zero, holding every sample until the next one.
+        For room_in_demand this is the time in demand"""
+        if self.count == 0:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+
+        timestamps = self._ordered(self.timestamps)
+        values = self._ordered(self.values)
+
+        window_start = timestamps[0] if seconds is None else now - seconds
+        # Include the sample before the window, it holds into the window
+        start = max(bisect_right(timestamps, window_start) - 1, 0)
+        begins = timestamps[start:]
+        values = values[start:]
+        if begins[0] < window_start:
+            begins[0] = window_start
+
+        ends = begins[1:]
+        ends.append(now)
+
+        return sum(map(sub, compress(ends, values), compress(begins, values)))
+
+class RegisterHistory(object):
+    """Ring buffers of recent samples, by register id. Only numeric values are recorded"""
+
+    def __init__(self, size=360):
+        self.size = size
+        self.buffers = {}
+
+    def buffer(self, id):
+        buffer = self.buffers.get(id)
+        if buffer is None:
+            buffer = self.buffers[id] = RingBuffer(self.size)
+        return buffer
+
+    def record(self, id, value, timestamp=None):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        self.buffer(id).append(value, timestamp)
+
+# Rolling windows of DutyCycle, in seconds
+DUTY_WINDOWS = {
+    '1h': 3600,
+    '24h': 86400,
+    '7d': 604800,
+}
+
+class RollingDuty(object):
+    """On-time fraction over a rolling window. The window is a ring of time buckets with running sums,
+    so accounting a sample costs O(1) regardless of the window length"""
+
+    def __init__(self, window, buckets=60):
+        self.window = window
+        self.buckets = buckets
+        self.bucket_length = window / buckets
+        self.on = array('d', bytes(8 * buckets))
+        self.total = array('d', bytes(8 * buckets))
+        self.on_sum = 0.0
+        self.total_sum = 0.0
+        # Absolute index (time // bucket_length) of the newest bucket
+        self.bucket = None
+
+    def _advance(self, index):
+        if self.bucket is None:
+            self.bucket = index
+            return
+        if index <= self.bucket:
+            return
+
+        # Expire the buckets that fell out of the window, at most all of them
+        for i in range(1, min(index - self.bucket, self.buckets) + 1):
+            slot = (self.bucket + i) % self.buckets
+            self.on_sum -= self.on[slot]
+            self.total_sum -= self.total[slot]
+            self.on[slot] = 0.0
+            self.total[slot] = 0.0
+        self.bucket = index
+
+    def add(self, start, end, on):
+        """Accounts the interval [start, end) as on or off"""
+        start = max(start, end - self.window)
+        while start < end:
+            index = max(int(start // self.bucket_length), self.bucket or 0)
+            self._advance(index)
+            chunk_end = min(end, (index + 1) * self.bucket_length)
+            if chunk_end <= start:
+                # Time went backwards, account it in the newest bucket
+                chunk_end = end
+            slot = index % self.buckets
+            duration = chunk_end - start
+            self.total[slot] += duration
+            self.total_sum += duration
+            if on:
+                self.on[slot] += duration
+                self.on_sum += duration
+            start = chunk_end
+
+    def value(self, now=None):
+        """Returns the on-time fraction 0..1, or None without samples in the window"""
+        if now is not None and self.bucket is not None:
+            self._advance(int(now // self.bucket_length))
+        if self.total_sum <= 0:
+            return None
+        return min(max(self.on_sum / self.total_sum, 0.0), 1.0)
+
+class DutyCycle(object):
+    """Duty cycle of an on/off signal over DUTY_WINDOWS, fed one sample at a time from the poll stream.
+    Each sample holds until the next, but at most max_hold seconds, so outages don't count as on or off"""
+
+    def __init__(self, windows=DUTY_WINDOWS, max_hold=600):
+        self.windows = {name: RollingDuty(seconds) for name, seconds in windows.items()}
+        self.max_hold = max_hold
+        self.last_timestamp = None
+        self.last_on = False
+
+    def sample(self, on, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            end = min(timestamp, self.last_timestamp + self.max_hold)
+            for window in self.windows.values():
+                window.add(self.last_timestamp, end, self.last_on)
+
+        self.last_timestamp = timestamp
+        self.last_on = bool(on)
+
+    def value(self, window, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.windows[window].value(now)
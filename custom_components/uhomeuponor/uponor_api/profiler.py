@@ -0,0 +1,200 @@
+"""Gateway tuning profiler
+
+Sweeps max_values_batch, max_batch_calls, request concurrency and request timeout against a gateway, the real one or
+the simulator's stand-in, and recommends the fastest combination within the error and rejection budgets. Requests are
+built like those of the update cycles, see UponorShard.read(). Run with the CLI:
+
+    python -m uponor_api 192.168.1.10 tune --output uhomeuponor_tuning.json
+
+The integration loads the recommendation from uhomeuponor_tuning.json in the Home Assistant configuration directory.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from . import UponorAPIException, UponorShard, REQUEST_RETRIES
+from .utilities import chunks
+
+_LOGGER = logging.getLogger(__name__)
+
+TUNING_FILE = "uhomeuponor_tuning.json"
+
+DEFAULT_BATCHES = (10, 20, 40, 60)
+DEFAULT_BATCH_CALLS = (1, 3)
+DEFAULT_CONCURRENCY = (1, 2, 4)
+DEFAULT_TIMEOUTS = (5, 10)
+# Combinations above these rates are only recommended if all are
+MAX_ERROR_RATE = 0.01
+MAX_REJECTION_RATE = 0.01
+
+ProfileResult = namedtuple('ProfileResult', ['max_values_batch', 'max_batch_calls', 'concurrency', 'timeout', 'requests',
+                                             'values_per_second', 'p50', 'p95', 'p99', 'error_rate', 'rejection_rate'])
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+class TimedSession(object):
+    """Wraps an aiohttp session, recording the latency and outcome of every request"""
+
+    def __init__(self, session):
+        self.session = session
+        self.reset()
+
+    def reset(self):
+        self.latencies = []
+        self.requests = 0
+        self.errors = 0
+
+    def post(self, *args, **kwargs):
+        return TimedPost(self, self.session.post(*args, **kwargs))
+
+class TimedPost(object):
+
+    def __init__(self, timed, post):
+        self.timed = timed
+        self.post = post
+        self.start = None
+        self.failed = False
+
+    async def __aenter__(self):
+        self.timed.requests += 1
+        self.start = time.perf_counter()
+        try:
+            response = await self.post.__aenter__()
+        except BaseException:
+            self.timed.errors += 1
+            raise
+        if response.status != 200:
+            self.failed = True
+            self.timed.errors += 1
+        return response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Includes reading the body
+        self.timed.latencies.append(time.perf_counter() - self.start)
+        if exc_type is not None and not self.failed:
+            self.timed.errors += 1
+        return await self.post.__aexit__(exc_type, exc, tb)
+
+async def profile_settings(client, timed, values, batch, batch_calls, concurrency, timeout, cycles):
+    """Reads all values cycles times, with concurrency workers sharing the requests, and measures the requests"""
+    client.apply_tuning({'max_values_batch': batch, 'max_batch_calls': batch_calls, 'max_concurrent_requests': concurrency,
+                         'timeout': timeout, 'retries': 0})
+    # A shard of its own, so the health of the update shards is left alone
+    shard = UponorShard(client, None)
+    timed.reset()
+    rejected = client.rejected_count
+    read = 0
+    calls = 0
+
+    start = time.perf_counter()
+    for _ in range(cycles):
+        # The values of one request: batch_calls batches of batch values
+        requests = iter(list(chunks(values, batch * batch_calls)))
+
+        async def worker():
+            nonlocal read, calls
+            # Workers share the iterator, so each request is sent once
+            for request_values in requests:
+                try:
+                    async for value_list in shard.read(request_values, None):
+                        read += len(value_list)
+                        calls += 1
+                except UponorAPIException:
+                    pass
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    # Rejections are counted per call, a request carries up to batch_calls of them
+    return ProfileResult(batch, batch_calls, concurrency, timeout, timed.requests,
+                         read / elapsed if elapsed > 0 else 0.0,
+                         percentile(timed.latencies, 50), percentile(timed.latencies, 95), percentile(timed.latencies, 99),
+                         timed.errors / max(timed.requests, 1),
+                         (client.rejected_count - rejected) / max(calls, 1))
+
+async def sweep(client, batches=DEFAULT_BATCHES, concurrencies=DEFAULT_CONCURRENCY, timeouts=DEFAULT_TIMEOUTS, cycles=5,
+                progress=None, batch_calls=DEFAULT_BATCH_CALLS):
+    """Profiles every combination against the devices of a rescanned client, returns the ProfileResults.
+    The client settings are restored afterwards"""
+    values = [value for device in [client.uhome] + client.controllers + client.thermostats for value in device.values()]
+    saved = {'max_values_batch': client.max_values_batch, 'max_batch_calls': client.max_batch_calls,
+             'max_concurrent_requests': client.max_concurrent_requests, 'retries': client.retries}
+    # Gateways that do not accept batches get one call per request whatever max_batch_calls is
+    if client.batch_calls is False:
+        batch_calls = (1,)
+    saved_timeout = client.timeout
+
+    timed = TimedSession(client.session)
+    client.session = timed
+    results = []
+    try:
+        for timeout in timeouts:
+            for concurrency in concurrencies:
+                for calls in batch_calls:
+                    for batch in batches:
+                        result = await profile_settings(client, timed, values, batch, calls, concurrency, timeout, cycles)
+                        results.append(result)
+                        if progress:
+                            progress(result)
+    finally:
+        client.session = timed.session
+        client.apply_tuning(saved)
+        client.timeout = saved_timeout
+
+    return results
+
+def recommend(results, host=None):
+    """Returns the recommended settings: the highest throughput within the error and rejection budgets"""
+    candidates = [result for result in results
+                  if result.error_rate <= MAX_ERROR_RATE and result.rejection_rate <= MAX_REJECTION_RATE]
+    if not candidates:
+        # Nothing is reliable, prefer the most reliable
+        lowest = min(result.error_rate + result.rejection_rate for result in results)
+        candidates = [result for result in results if result.error_rate + result.rejection_rate == lowest]
+
+    best = max(candidates, key=lambda result: (result.values_per_second, -(result.p95 or 0)))
+
+    # Without errors one retry covers the odd glitch, flaky gateways get more
+    if best.error_rate == 0:
+        retries = 1
+    elif best.error_rate <= MAX_ERROR_RATE:
+        retries = REQUEST_RETRIES
+    else:
+        retries = REQUEST_RETRIES + 1
+
+    return {
+        'host': host,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'max_values_batch': best.max_values_batch,
+        'max_batch_calls': best.max_batch_calls,
+        'max_concurrent_requests': best.concurrency,
+        'timeout': best.timeout,
+        'retries': retries,
+        'measured': best._asdict(),
+    }
+
+def save_tuning(path, tuning):
+    with open(path, 'w') as file:
+        json.dump(tuning, file, indent=2)
+
+def load_tuning(path):
+    """Returns the tuning saved at path, or None if there is none"""
+    try:
+        with open(path) as file:
+            tuning = json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        _LOGGER.warning("Ignoring invalid tuning file %s: %s", path, ex)
+        return None
+    return tuning if isinstance(tuning, dict) else None
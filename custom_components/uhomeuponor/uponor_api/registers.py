@@ -0,0 +1,70 @@
+"""Register layouts of the Uponor device types, compiled once at import from the register tables in const.py"""
+
+from collections import namedtuple
+from types import MappingProxyType
+
+from .const import *
+from .codec import codec
+
+# Poll classes
+POLL_CORE = 'core'
+POLL_EXTENDED = 'extended'
+
+# Hard TTL by poll class: seconds after its last read a value is stale. A register table entry can set its own with
+# 'stale_after'. Core registers are read at least every 5 minutes, extended registers every 10 minutes
+STALE_AFTER_SECONDS = {POLL_CORE: 600, POLL_EXTENDED: 1800}
+
+# A register of a device type. slot is the index within the device's block of the value store,
+# addr the offset to add to the device's id offset, decode the type name of its codec
+Register = namedtuple('Register', ['slot', 'name', 'addr', 'property', 'poll', 'decode', 'default', 'stale_after', 'codec'])
+
+class RegisterLayout(object):
+    """Immutable layout of the registers of a device type, shared by all devices of that type"""
+
+    __slots__ = ('registers', 'by_name', 'by_addr', 'core', 'extended', 'defaults', 'defaults_in_range', 'size')
+
+    def __init__(self, *tables):
+        """Accepts (register table, poll class) tuples"""
+        registers = []
+        for table, poll in tables:
+            for name, data in table.items():
+                registers.append(Register(len(registers), name, data['addr'], data['property'], poll,
+                                          data.get('type', 'raw'), data['value'],
+                                          data.get('stale_after', STALE_AFTER_SECONDS[poll]), codec(data)))
+
+        self.registers = tuple(registers)
+        self.by_name = MappingProxyType({register.name: register for register in registers})
+        self.by_addr = MappingProxyType({register.addr: register for register in registers})
+        self.core = tuple(register for register in registers if register.poll == POLL_CORE)
+        self.extended = tuple(register for register in registers if register.poll == POLL_EXTENDED)
+        self.defaults = tuple(register.default for register in registers)
+        self.defaults_in_range = tuple(register.codec.in_range(register.default) for register in registers)
+        self.size = len(registers)
+
+UHOME_LAYOUT = RegisterLayout((UHOME_MODULE_KEYS, POLL_CORE))
+CONTROLLER_LAYOUT = RegisterLayout((UHOME_CONTROLLER_KEYS, POLL_CORE))
+THERMOSTAT_LAYOUT = RegisterLayout((UHOME_THERMOSTAT_KEYS, POLL_CORE), (UHOME_THERMOSTAT_EXTENDED_KEYS, POLL_EXTENDED))
+
+class UponorValueStore(object):
+    """Values of all devices of a client, in one flat list. Each device owns a block of slots, laid out by its RegisterLayout.
+    times holds the monotonic time each value was read, None until its first read, and in_range whether each value is
+    within the min and max of its register"""
+
+    def __init__(self):
+        self.values = []
+        self.times = []
+        self.in_range = []
+
+    def allocate(self, layout):
+        """Reserves a block for a device, initialized with the register defaults, and returns its base slot"""
+        base = len(self.values)
+        self.values.extend(layout.defaults)
+        self.times.extend([None] * layout.size)
+        self.in_range.extend(layout.defaults_in_range)
+        return base
+
+    def truncate(self, size):
+        """Releases every block after the first size slots"""
+        del self.values[size:]
+        del self.times[size:]
+        del self.in_range[size:]
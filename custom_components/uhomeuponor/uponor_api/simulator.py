@@ -0,0 +1,346 @@
+"""Local stand-in for a U@Home gateway, with fault injection
+
+Used to exercise the client's recovery paths (do_rest_call retries, the pending_update reset in
+update_devices and validate_values) without a real R-167, see tests/test_simulator.py for the checks.
+Run from the custom_components/uhomeuponor directory:
+
+    python -m uponor_api.simulator chaos --cycles 200 --rate 0.1
+    python -m uponor_api.simulator chaos --faults read_timeout,neighbour_corruption --rate 0.3
+    python -m uponor_api.simulator serve --port 8080 --rate 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+
+import aiohttp
+
+from . import UponorClient
+from .profiler import percentile
+from .registers import UHOME_LAYOUT, CONTROLLER_LAYOUT, THERMOSTAT_LAYOUT
+
+_LOGGER = logging.getLogger(__name__)
+
+FAULTS = (
+    'connect_timeout',       # request never reaches the gateway
+    'read_timeout',          # gateway does not answer in time
+    'http_500',              # gateway answers with an error status
+    'truncated_json',        # response body is cut short
+    'missing_result',        # JSON-RPC response without 'result'
+    'neighbour_corruption',  # setpoints and temperatures of the next thermostat, a known R-167 bug
+)
+
+# Thermostat registers the R-167 returns from the next thermostat, all of them in a corrupted response, see
+# UponorClient.validate_values(). The last thermostat of a controller has no next thermostat and is never corrupted
+CORRUPTED_ADDRS = (11, 25)
+
+class GatewaySimulator(object):
+    """In-memory U@Home gateway answering read and write JSON-RPC requests"""
+
+    def __init__(self, controllers=1, thermostats=8, seed=0, batches=True):
+        rng = random.Random(seed)
+        self.registers = {}
+        self.requests = 0
+        # Whether JSON-RPC batches are answered, or rejected like by a gateway that does not support them
+        self.batches = batches
+
+        def add(offset, layout, values):
+            for register in layout.registers:
+                self.registers[offset + register.addr] = values.get(register.name, register.default)
+
+        add(0, UHOME_LAYOUT, {'module_id': 16000 + seed, 'controller_presence': (1 << controllers) - 1,
+                              'average_room_temperature': 21.0})
+        self.thermostat_offsets = []
+        for c in range(controllers):
+            add(60 + 500 * c, CONTROLLER_LAYOUT, {'thermostat_presence': (1 << thermostats) - 1, 'supply_temp': 30.0})
+            for t in range(thermostats):
+                offset = 80 + 500 * c + 40 * t
+                self.thermostat_offsets.append(offset)
+                add(offset, THERMOSTAT_LAYOUT, {
+                    'room_name': f"Room {c}.{t}",
+                    'room_temperature': round(rng.uniform(18.0, 24.0), 1),
+                    'room_setpoint': round(rng.uniform(18.0, 23.0) * 2) / 2,
+                    'rh_value': rng.randint(35, 55),
+                    'room_in_demand': rng.randint(0, 1),
+                    'utilization_factor_24h': rng.randint(0, 100),
+                    'utilization_factor_7d': rng.randint(0, 100),
+                })
+
+    def handle(self, request, corrupt=False):
+        """Answers a JSON-RPC request object, or a batch of them. corrupt returns neighbour values for the corruptible registers"""
+        if isinstance(request, list):
+            if not self.batches:
+                return {'jsonrpc': "2.0", 'id': None, 'error': {'code': -32600, 'message': "Invalid Request"}}
+            return [self.handle(item, corrupt) for item in request]
+
+        self.requests += 1
+        method = request.get('method')
+        if method not in ('read', 'write'):
+            return {'jsonrpc': "2.0", 'id': request.get('id'), 'error': {'code': -32601, 'message': "Method not found"}}
+
+        objects = []
+        for obj in request['params']['objects']:
+            id = int(obj['id'])
+            prop, data = next(iter(obj['properties'].items()))
+            if method == 'write' and id in self.registers:
+                self.registers[id] = self.parse(data['value'])
+
+            value = self.registers.get(id, 0)
+            if corrupt and (id - 80) % 500 % 40 in CORRUPTED_ADDRS and id + 40 in self.registers:
+                value = self.registers[id + 40]
+            objects.append({'id': obj['id'], 'properties': {prop: {'value': value}}})
+
+        return {'jsonrpc': "2.0", 'id': request.get('id'), 'result': {'objects': objects}}
+
+    @staticmethod
+    def parse(text):
+        for kind in (int, float):
+            try:
+                return kind(text)
+            except ValueError:
+                pass
+        return text
+
+    def mismatches(self, client):
+        """Counts core values of valid thermostats, as entities would show them, that differ from the gateway"""
+        count = 0
+        for thermostat in client.thermostats:
+            if not thermostat.is_valid():
+                continue
+            for value in thermostat.values():
+                if value.value != self.registers.get(value.id):
+                    count += 1
+        return count
+
+class FaultInjector(object):
+    """Picks a fault, or None, for every request"""
+
+    def __init__(self, faults=FAULTS, rate=0.1, seed=0):
+        self.faults = tuple(faults)
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self.injected = Counter()
+
+    def pick(self):
+        if not self.faults or self.rng.random() >= self.rate:
+            return None
+        fault = self.rng.choice(self.faults)
+        self.injected[fault] += 1
+        return fault
+
+    def render(self, gateway, request, fault):
+        """Returns (status, body) for a request, with the fault applied"""
+        if fault == 'http_500':
+            return 500, "Internal Server Error"
+        response = gateway.handle(request, corrupt=fault == 'neighbour_corruption')
+        if fault == 'missing_result':
+            for item in response if isinstance(response, list) else [response]:
+                item.pop('result', None)
+        body = json.dumps(response)
+        if fault == 'truncated_json':
+            body = body[:len(body) // 2]
+        return 200, body
+
+class SimulatedResponse(object):
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def text(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+class SimulatedSession(object):
+    """Stands in for an aiohttp.ClientSession, answering from a GatewaySimulator in-process.
+    Timeouts cost timeout_cost seconds instead of the real request timeout"""
+
+    def __init__(self, gateway, injector=None, latency=0.002, timeout_cost=0.05):
+        self.gateway = gateway
+        self.injector = injector
+        self.latency = latency
+        self.timeout_cost = timeout_cost
+
+    def post(self, url, data=None, timeout=None):
+        return SimulatedPost(self._post(data))
+
+    async def _post(self, data):
+        fault = self.injector.pick() if self.injector else None
+        if fault in ('connect_timeout', 'read_timeout'):
+            await asyncio.sleep(self.timeout_cost)
+            if fault == 'connect_timeout':
+                raise asyncio.TimeoutError()
+            raise aiohttp.ServerTimeoutError("Simulated read timeout")
+
+        await asyncio.sleep(self.latency)
+        injector = self.injector or FaultInjector(rate=0)
+        status, body = injector.render(self.gateway, json.loads(data), fault)
+        return SimulatedResponse(status, body)
+
+class SimulatedPost(object):
+    """Makes SimulatedSession.post usable as 'async with', like aiohttp"""
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.response = None
+
+    async def __aenter__(self):
+        self.response = await self.coro
+        return self.response
+
+    async def __aexit__(self, *args):
+        return False
+
+class ChaosReport(object):
+    """Resilience metrics of a fault injection run"""
+
+    def __init__(self):
+        self.cycles = 0
+        self.failed_cycles = 0
+        self.errors = Counter()
+        self.recovery_times = []
+        self.recovery_cycles = []
+        self.bad_values = 0
+        self.stuck_pending = 0
+        self.requests = 0
+        self.baseline_requests = 0
+        self.injected = Counter()
+
+    def __str__(self):
+        lines = [
+            f"cycles              {self.cycles}, {self.failed_cycles} failed",
+            f"faults injected     {dict(self.injected) or 'none'}",
+            f"errors raised       {dict(self.errors) or 'none'}",
+            f"bad values shown    {self.bad_values} (value reads of valid thermostats that differ from the gateway)",
+            f"stuck pending       {self.stuck_pending} (devices left pending_update after a cycle)",
+            f"requests            {self.requests}, {self.requests / max(self.baseline_requests, 1):.2f}x the fault-free cost",
+        ]
+        if self.recovery_times:
+            lines.append(f"recovery            {len(self.recovery_times)} outages, p50 {percentile(self.recovery_times, 50):.3f}s / "
+                         f"{percentile(self.recovery_cycles, 50)} cycles, max {max(self.recovery_times):.3f}s / "
+                         f"{max(self.recovery_cycles)} cycles")
+        return "\n".join(lines)
+
+async def run_chaos(cycles=100, faults=FAULTS, rate=0.1, seed=0, controllers=1, thermostats=8, retry_delay=0.05):
+    """Runs poll cycles of a client against a faulty simulated gateway, and reports how it recovers"""
+    gateway = GatewaySimulator(controllers, thermostats, seed)
+    session = SimulatedSession(gateway)
+    client = UponorClient(None, "simulator", session)
+    client.retry_delay = retry_delay
+
+    # Rescan fault-free, then poll every device in every cycle
+    await client.rescan()
+    client.adaptive_polling = False
+    client.max_update_interval = timedelta(0)
+    devices = [client.uhome] + client.controllers + client.thermostats
+
+    report = ChaosReport()
+    # Every shard reads its devices in its own batches, several batches per request
+    shard_values = {}
+    for device in devices:
+        shard_values.setdefault(device.shard_index, []).extend(device.values())
+    batches = [len(list(client.shard(index).batches(values))) for index, values in shard_values.items()]
+    report.baseline_requests = cycles * sum(-(-count // client.max_batch_calls) for count in batches)
+
+    session.injector = FaultInjector(faults, rate, seed)
+    failing_since = None
+    failing_cycles = 0
+    requests = client.request_count
+
+    for _ in range(cycles):
+        start = time.monotonic()
+        try:
+            await client.update_devices(devices)
+            failed = False
+        except Exception as ex:
+            failed = True
+            report.errors[type(ex).__name__] += 1
+
+        report.cycles += 1
+        report.bad_values += gateway.mismatches(client)
+        report.stuck_pending += sum(1 for device in devices if device.pending_update)
+
+        if failed:
+            report.failed_cycles += 1
+            failing_cycles += 1
+            if failing_since is None:
+                failing_since = start
+        elif failing_since is not None:
+            report.recovery_times.append(time.monotonic() - failing_since)
+            report.recovery_cycles.append(failing_cycles)
+            failing_since = None
+            failing_cycles = 0
+
+    report.requests = client.request_count - requests
+    report.injected = session.injector.injected
+    return report
+
+async def serve(host='127.0.0.1', port=8080, controllers=1, thermostats=8, faults=FAULTS, rate=0.0, seed=0, timeout_cost=15):
+    """Serves a simulated gateway over HTTP at http://host:port/api, until cancelled"""
+    from aiohttp import web
+
+    gateway = GatewaySimulator(controllers, thermostats, seed)
+    injector = FaultInjector(faults, rate, seed)
+
+    async def handle(request):
+        fault = injector.pick()
+        if fault in ('connect_timeout', 'read_timeout'):
+            # Longer than the client timeout
+            await asyncio.sleep(timeout_cost)
+        status, body = injector.render(gateway, json.loads(await request.text()), fault)
+        return web.Response(status=status, text=body, content_type='application/json')
+
+    app = web.Application()
+    app.router.add_post('/api', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    _LOGGER.info("Simulated gateway listening on http://%s:%d/api", host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="uponor_api.simulator", description="Simulated U@Home gateway with fault injection")
+    parser.add_argument('command', choices=('chaos', 'serve'))
+    parser.add_argument('--controllers', type=int, default=1)
+    parser.add_argument('--thermostats', type=int, default=8, help="Thermostats per controller (default 8)")
+    parser.add_argument('--faults', default=','.join(FAULTS), help=f"Comma separated faults (default all: {','.join(FAULTS)})")
+    parser.add_argument('--rate', type=float, default=None, help="Fault rate per request (default chaos: 0.1, serve: 0)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cycles', type=int, default=100, help="chaos: poll cycles (default 100)")
+    parser.add_argument('--host', default='127.0.0.1', help="serve: address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="serve: port to listen on")
+    args = parser.parse_args(argv)
+
+    faults = [fault for fault in args.faults.split(',') if fault]
+    unknown = set(faults) - set(FAULTS)
+    if unknown:
+        raise SystemExit(f"Unknown faults: {', '.join(sorted(unknown))}")
+
+    # The chaos report summarizes the errors the client would log
+    logging.basicConfig(level=logging.INFO if args.command == 'serve' else logging.CRITICAL)
+    try:
+        if args.command == 'chaos':
+            rate = 0.1 if args.rate is None else args.rate
+            print(asyncio.run(run_chaos(args.cycles, faults, rate, args.seed, args.controllers, args.thermostats)))
+        else:
+            rate = 0.0 if args.rate is None else args.rate
+            asyncio.run(serve(args.host, args.port, args.controllers, args.thermostats, faults, rate, args.seed))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import time
+
 def flatten(*args):
     output = []
     for arg in args:
@@ -10,4 +12,14 @@ def flatten(*args):
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
-        yield lst[i:i + n]
\ No newline at end of file
+        yield lst[i:i + n]
+
+class Deadline(object):
+    """Time budget of a poll cycle or rescan, passed down to every request made for it"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
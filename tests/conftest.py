@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# uponor_api is standalone, it is imported from the integration directory like the command line client
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "custom_components" / "uhomeuponor"))
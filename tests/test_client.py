@@ -0,0 +1,246 @@
+"""Client behaviour against the simulated gateway. Run from the repository root with: python -m pytest tests"""
+
+import asyncio
+import time
+from datetime import timedelta
+
+import aiohttp
+import pytest
+
+from uponor_api import UponorClient, UponorAPIException, UponorDeadlineException, MIN_REQUEST_SECONDS, SHARD_DEGRADED_FAILURES
+from uponor_api.history import DutyCycle, RingBuffer
+from uponor_api.simulator import GatewaySimulator, SimulatedSession
+from uponor_api.utilities import Deadline
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def connect(controllers=1, thermostats=8):
+    gateway = GatewaySimulator(controllers, thermostats)
+    client = UponorClient(None, "simulator", SimulatedSession(gateway))
+    client.retry_delay = 0.01
+    await client.rescan()
+    return gateway, client
+
+def test_restore_snapshot():
+    async def scenario():
+        gateway, client = await connect()
+        restored = UponorClient(None, "simulator", client.session)
+        assert restored.restore(client.snapshot())
+        assert [thermostat.key for thermostat in restored.thermostats] == [thermostat.key for thermostat in client.thermostats]
+        assert all(thermostat.state.restored and thermostat.state.valid for thermostat in restored.thermostats)
+        assert gateway.mismatches(restored) == 0
+
+    run(scenario())
+
+def test_restore_refuses_snapshot_without_new_thermostat():
+    async def scenario():
+        gateway, client = await connect(thermostats=4)
+        # A fifth thermostat is paired, revalidate() reads the new presence but keeps the devices
+        added = GatewaySimulator(1, 5)
+        gateway.registers.update({id: value for id, value in added.registers.items() if id not in gateway.registers})
+        gateway.registers[client.controllers[0].by_name('thermostat_presence').id] = 0b11111
+        assert not await client.revalidate()
+
+        restored = UponorClient(None, "simulator", client.session)
+        assert not restored.restore(client.snapshot())
+        assert restored.thermostats == []
+
+    run(scenario())
+
+class BatchDroppingSession(SimulatedSession):
+    """A gateway that drops the connection on JSON-RPC batches, or on every request while down"""
+
+    down = False
+
+    async def _post(self, data):
+        if self.down or data.startswith('['):
+            raise aiohttp.ClientConnectionError("Server disconnected")
+        return await super()._post(data)
+
+def test_batches_are_used_when_accepted():
+    async def scenario():
+        gateway, client = await connect()
+        assert client.batch_calls is True
+
+    run(scenario())
+
+def test_batches_off_when_rejected_with_an_error():
+    async def scenario():
+        gateway = GatewaySimulator(1, 8, batches=False)
+        client = UponorClient(None, "simulator", SimulatedSession(gateway))
+        await client.rescan()
+        assert client.batch_calls is False
+        assert gateway.mismatches(client) == 0
+
+    run(scenario())
+
+def test_batches_off_when_rejected_with_a_dropped_connection():
+    async def scenario():
+        gateway = GatewaySimulator(1, 8)
+        client = UponorClient(None, "simulator", BatchDroppingSession(gateway))
+        client.retry_delay = 0.01
+        await client.rescan()
+        assert client.batch_calls is False
+        assert gateway.mismatches(client) == 0
+
+    run(scenario())
+
+def test_batches_undecided_while_the_gateway_is_down():
+    async def scenario():
+        gateway = GatewaySimulator(1, 8)
+        session = BatchDroppingSession(gateway)
+        client = UponorClient(None, "simulator", session)
+        client.retry_delay = 0.01
+        # The U@Home and the controller fit in one call each, the thermostats are the first batch
+        await client.uhome.async_update()
+        await client.init_controllers()
+        session.down = True
+        with pytest.raises(UponorAPIException):
+            await client.init_thermostats()
+        assert client.batch_calls is None
+
+        session.down = False
+        await client.update_devices(client.thermostats)
+        assert client.batch_calls is False
+
+    run(scenario())
+
+class SlowSession(SimulatedSession):
+    """Answers every request after delay seconds, and records the timeouts requests are posted with"""
+
+    delay = 0
+
+    def __init__(self, gateway):
+        super().__init__(gateway)
+        self.timeouts = []
+
+    def post(self, url, data=None, timeout=None):
+        self.timeouts.append(timeout)
+        return super().post(url, data, timeout)
+
+    async def _post(self, data):
+        await asyncio.sleep(self.delay)
+        return await super()._post(data)
+
+def test_no_request_without_budget_after_waiting_for_a_slot():
+    async def scenario():
+        gateway = GatewaySimulator(2, 2)
+        session = SlowSession(gateway)
+        client = UponorClient(None, "simulator", session)
+        await client.rescan()
+        client.set_max_concurrent_requests(1)
+        session.delay = 1.6
+        session.timeouts.clear()
+        for controller in client.controllers:
+            controller.last_update = None
+        # The second shard waits for the slot until its budget is gone
+        with pytest.raises(UponorDeadlineException):
+            await client.update_devices(client.controllers, deadline=Deadline(2))
+        assert len(session.timeouts) == 1
+        assert all(timeout.total >= MIN_REQUEST_SECONDS for timeout in session.timeouts)
+
+    run(scenario())
+
+def test_revalidate_right_after_an_outage():
+    async def scenario():
+        gateway = GatewaySimulator(2, 2)
+        session = BatchDroppingSession(gateway)
+        client = UponorClient(None, "simulator", session)
+        client.retry_delay = 0.01
+        await client.rescan()
+        client.adaptive_polling = False
+        client.max_update_interval = timedelta(0)
+        devices = [client.uhome] + client.controllers + client.thermostats
+
+        session.down = True
+        for _ in range(SHARD_DEGRADED_FAILURES):
+            with pytest.raises(UponorAPIException):
+                await client.update_devices(devices)
+        assert all(shard.degraded and shard.retry_at is not None for shard in client.shards.values())
+
+        # The gateway is back, the watchdog's revalidate() does not wait for the backoff
+        session.down = False
+        assert await client.revalidate()
+        assert not any(shard.degraded for shard in client.shards.values())
+
+    run(scenario())
+
+def test_joining_a_running_cycle_keeps_the_callers_deadline():
+    async def scenario():
+        gateway = GatewaySimulator(1, 2)
+        session = SlowSession(gateway)
+        client = UponorClient(None, "simulator", session)
+        await client.rescan()
+        session.delay = 1.0
+        client.controllers[0].last_update = None
+        first = asyncio.ensure_future(client.update_devices(client.controllers))
+        await asyncio.sleep(0)
+
+        # The second caller joins the running cycle, but only waits for its own budget
+        started = time.monotonic()
+        with pytest.raises(UponorDeadlineException):
+            await client.update_devices(client.controllers, deadline=Deadline(0.3))
+        assert time.monotonic() - started < 0.6
+
+        # The cycle goes on for the first caller
+        await first
+        assert gateway.mismatches(client) == 0
+
+    run(scenario())
+
+def test_ring_buffer_keeps_the_newest_samples_in_order():
+    buffer = RingBuffer(4)
+    assert len(buffer) == 0 and buffer.last() is None
+    assert buffer.mean() is None and buffer.rate_of_change() is None
+
+    for t in range(3):
+        buffer.append(20.0 + t, timestamp=float(t))
+    assert len(buffer) == 3
+    assert list(buffer.window()[1]) == [20.0, 21.0, 22.0]
+
+    # Wraps around, overwriting the oldest samples
+    for t in range(3, 7):
+        buffer.append(20.0 + t, timestamp=float(t))
+    assert len(buffer) == 4
+    timestamps, values = buffer.window()
+    assert list(timestamps) == [3.0, 4.0, 5.0, 6.0]
+    assert list(values) == [23.0, 24.0, 25.0, 26.0]
+    assert buffer.last() == (6.0, 26.0)
+
+    # Windows count back from now
+    assert list(buffer.window(1.5, now=6.0)[1]) == [25.0, 26.0]
+    assert buffer.minimum(now=6.0) == 23.0 and buffer.maximum(now=6.0) == 26.0
+    assert buffer.mean(1.5, now=6.0) == 25.5
+    assert buffer.rate_of_change() == pytest.approx(3600.0)
+
+def test_ring_buffer_time_true_after_wraparound():
+    buffer = RingBuffer(3)
+    for t, on in ((0, 1), (10, 0), (20, 1), (30, 0)):
+        buffer.append(on, timestamp=float(t))
+    # The first sample was overwritten, the window starts at the oldest kept one
+    assert buffer.time_true(now=40.0) == 10.0
+    # The sample before a window holds into it
+    assert buffer.time_true(15, now=35.0) == 10.0
+
+def test_duty_cycle():
+    duty = DutyCycle(windows={'1h': 3600, '24h': 86400}, max_hold=600)
+    # No samples, or a single one, cover no time yet
+    assert duty.value('1h', now=0.0) is None
+    duty.sample(True, 0.0)
+    assert duty.value('1h', now=0.0) is None
+
+    # On for 300s, then off for 600s
+    duty.sample(False, 300.0)
+    assert duty.value('1h', now=300.0) == 1.0
+    duty.sample(False, 900.0)
+    assert duty.value('1h', now=900.0) == pytest.approx(1 / 3)
+
+    # An outage only holds the last sample for max_hold
+    duty.sample(True, 900.0 + 3000)
+    assert duty.value('24h', now=3900.0) == pytest.approx(300 / 1500)
+
+    # The first on time fell out of the hour, not out of the day. The hour expires by the minute
+    duty.sample(False, 4200.0)
+    assert duty.value('1h', now=4200.0) == pytest.approx(300 / 1200, abs=0.02)
+    assert duty.value('24h', now=4200.0) == pytest.approx(600 / 1800)
@@ -0,0 +1,64 @@
+"""Typed register codecs, see uponor_api/codec.py. Run from the repository root with: python -m pytest tests"""
+
+import asyncio
+
+import pytest
+
+from uponor_api import UponorClient
+from uponor_api.codec import codec
+from uponor_api.registers import THERMOSTAT_LAYOUT
+from uponor_api.simulator import GatewaySimulator, SimulatedSession
+
+@pytest.mark.parametrize('data,value', [
+    ({'type': 'float', 'min': 1, 'max': 40}, 21.5),
+    ({'type': 'int'}, 3),
+    ({'type': 'bool'}, True),
+    ({'type': 'bool'}, False),
+    ({'type': 'enum', 'choices': (0, 1)}, 1),
+    ({'type': 'bitmask', 'bits': 4}, 0b1011),
+    ({'type': 'string'}, "Living room"),
+    ({}, "85"),
+])
+def test_round_trip(data, value):
+    register = codec(data)
+    assert register.decode(register.encode(value)) == value
+    assert register.decode(value) == value
+
+@pytest.mark.parametrize('data,value', [
+    ({'type': 'float'}, "warm"),
+    ({'type': 'float'}, "nan"),
+    ({'type': 'float'}, True),
+    ({'type': 'float'}, None),
+    ({'type': 'int'}, 2.5),
+    ({'type': 'enum', 'choices': (0, 1)}, 2),
+    ({'type': 'bitmask', 'bits': 4}, 16),
+    ({'type': 'bitmask', 'bits': 4}, -1),
+    ({'type': 'string'}, None),
+    ({'type': 'string'}, [1]),
+])
+def test_malformed_values_are_refused(data, value):
+    with pytest.raises((TypeError, ValueError)):
+        codec(data).decode(value)
+
+def test_out_of_range_values_are_kept_but_not_in_range():
+    setpoint = codec({'type': 'float', 'min': 1, 'max': 40})
+    assert setpoint.decode(0) == 0
+    assert not setpoint.in_range(0)
+    with pytest.raises(ValueError):
+        setpoint.encode(0)
+
+def test_humidity_with_decimals_is_read():
+    async def scenario():
+        gateway = GatewaySimulator(1, 1)
+        client = UponorClient(None, "simulator", SimulatedSession(gateway))
+        await client.rescan()
+        thermostat = client.thermostats[0]
+        gateway.registers[thermostat.by_name('rh_value').id] = 47.5
+        thermostat.last_update = None
+        await client.update_devices(thermostat)
+        assert thermostat.state.rh_value == 47.5
+        assert client.malformed_count == 0
+        assert not thermostat.state.is_stale()
+
+    assert THERMOSTAT_LAYOUT.by_name['rh_value'].codec.decode("47.5") == 47.5
+    asyncio.run(scenario())
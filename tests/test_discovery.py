@@ -0,0 +1,76 @@
+"""Gateway discovery against simulated gateways and other hosts. Run from the repository root with: python -m pytest tests"""
+
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+
+from uponor_api.discovery import Gateway, discover, network_hosts
+from uponor_api.simulator import GatewaySimulator, SimulatedResponse, SimulatedSession, serve
+
+class NetworkSession(object):
+    """Stands in for an aiohttp.ClientSession on a network: simulated gateways by host, a web server that is not a
+    gateway, and nothing listening on the other hosts"""
+
+    def __init__(self, gateways, others=()):
+        self.sessions = {host: SimulatedSession(gateway) for host, gateway in gateways.items()}
+        self.others = set(others)
+        self.probed = []
+
+    def post(self, url, data=None, timeout=None):
+        host = url.split('/')[2]
+        self.probed.append(host)
+        if host in self.sessions:
+            return self.sessions[host].post(url, data, timeout)
+        return OtherHostPost(host in self.others)
+
+class OtherHostPost(object):
+
+    def __init__(self, listening):
+        self.listening = listening
+
+    async def __aenter__(self):
+        if not self.listening:
+            raise aiohttp.ClientConnectionError("Connection refused")
+        return SimulatedResponse(200, "<html>Router</html>")
+
+    async def __aexit__(self, *args):
+        return False
+
+def test_discover_finds_the_gateways_in_host_order():
+    hosts = network_hosts('192.168.1.0/28')
+    session = NetworkSession({'192.168.1.9': GatewaySimulator(2, 4, seed=1), '192.168.1.3': GatewaySimulator(1, 4)},
+                             others=['192.168.1.1'])
+    gateways = asyncio.run(discover(session, hosts, concurrency=4))
+    assert gateways == [Gateway('192.168.1.3', 16000, [0]), Gateway('192.168.1.9', 16001, [0, 1])]
+    assert sorted(session.probed) == sorted(hosts)
+
+def test_network_hosts_refuses_large_networks():
+    assert len(network_hosts('10.0.0.0/24')) == 254
+    with pytest.raises(ValueError):
+        network_hosts('10.0.0.0/16')
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_discover_a_served_simulator():
+    async def scenario():
+        port = free_port()
+        server = asyncio.ensure_future(serve('127.0.0.1', port, controllers=2, thermostats=2))
+        try:
+            async with aiohttp.ClientSession() as session:
+                hosts = [f"127.0.0.1:{port}", f"127.0.0.1:{free_port()}"]
+                for _ in range(50):
+                    gateways = await discover(session, hosts, timeout=1)
+                    if gateways:
+                        break
+                    await asyncio.sleep(0.05)
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+        assert gateways == [Gateway(f"127.0.0.1:{port}", 16000, [0, 1])]
+
+    asyncio.run(scenario())
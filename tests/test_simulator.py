@@ -0,0 +1,213 @@
+"""Recovery paths of the client against the simulated gateway: do_rest_call retries, the pending_update reset of
+failed update cycles, validate_values and quarantine. Run from the repository root with: python -m pytest tests"""
+
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from uponor_api import UponorClient, UponorAPIException, QUARANTINE_REJECTED_UPDATES
+from uponor_api.simulator import CORRUPTED_ADDRS, FAULTS, FaultInjector, GatewaySimulator, SimulatedSession, run_chaos
+
+class ScriptedInjector(FaultInjector):
+    """Injects the faults given, one per request, then none"""
+
+    def __init__(self, faults):
+        super().__init__(rate=0)
+        self.script = list(faults)
+
+    def pick(self):
+        fault = self.script.pop(0) if self.script else None
+        if fault is not None:
+            self.injected[fault] += 1
+        return fault
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def connect(controllers=1, thermostats=8, **gateway_args):
+    gateway = GatewaySimulator(controllers, thermostats, **gateway_args)
+    session = SimulatedSession(gateway)
+    client = UponorClient(None, "simulator", session)
+    client.retry_delay = 0.01
+    await client.rescan()
+    client.adaptive_polling = False
+    client.max_update_interval = timedelta(0)
+    return gateway, session, client
+
+def devices(client):
+    return [client.uhome] + client.controllers + client.thermostats
+
+@pytest.mark.parametrize('fault', ['connect_timeout', 'read_timeout', 'truncated_json'])
+def test_rest_call_retries_transient_faults(fault):
+    async def scenario():
+        gateway, session, client = await connect()
+        session.injector = ScriptedInjector([fault] * client.retries)
+        requests = client.request_count
+        response = await client.do_rest_call(client.read_request(client.uhome.values()))
+        assert 'result' in response
+        assert client.request_count - requests == client.retries + 1
+
+    run(scenario())
+
+def test_rest_call_gives_up_after_retries():
+    async def scenario():
+        gateway, session, client = await connect()
+        session.injector = ScriptedInjector(['read_timeout'] * (client.retries + 1))
+        with pytest.raises(UponorAPIException):
+            await client.do_rest_call(client.read_request(client.uhome.values()))
+
+    run(scenario())
+
+@pytest.mark.parametrize('fault', ['http_500', 'missing_result', 'connect_timeout'])
+def test_failed_cycle_resets_pending_update(fault):
+    async def scenario():
+        gateway, session, client = await connect()
+        client.retries = 0
+        session.injector = ScriptedInjector([fault])
+        with pytest.raises(UponorAPIException):
+            await client.update_devices(devices(client))
+        assert not any(device.pending_update for device in devices(client))
+
+        # The next cycle reads every device again
+        await client.update_devices(devices(client))
+        assert gateway.mismatches(client) == 0
+
+    run(scenario())
+
+def thermostat_response(gateway, client, thermostat, corrupt):
+    return gateway.handle(client.read_request(thermostat.values()), corrupt=corrupt)
+
+@pytest.mark.parametrize('controllers,thermostats', [(1, 8), (2, 12)])
+def test_validate_values_rejects_neighbour_values(controllers, thermostats):
+    async def scenario():
+        gateway, session, client = await connect(controllers, thermostats)
+        for thermostat in client.thermostats:
+            # The last thermostat of a controller has no neighbour to take values from
+            if thermostat.thermostat_index == thermostats - 1:
+                continue
+            assert not client.validate_values(thermostat_response(gateway, client, thermostat, True)), thermostat.key
+            assert client.validate_values(thermostat_response(gateway, client, thermostat, False)), thermostat.key
+
+    run(scenario())
+
+def test_validate_values_accepts_neighbours_with_the_same_values():
+    async def scenario():
+        gateway, session, client = await connect(thermostats=2)
+        first, second = client.thermostats
+        for name in ('room_setpoint', 'room_temperature'):
+            gateway.registers[second.by_name(name).id] = gateway.registers[first.by_name(name).id]
+        await client.update_devices(client.thermostats)
+        assert client.validate_values(thermostat_response(gateway, client, first, False))
+
+    run(scenario())
+
+@pytest.mark.parametrize('controllers,thermostats,rate', [(1, 8, 0.3), (2, 12, 0.3), (4, 12, 0.1)])
+def test_chaos_neighbour_corruption_shows_no_bad_values(controllers, thermostats, rate):
+    report = run(run_chaos(100, ['neighbour_corruption'], rate, 0, controllers, thermostats, retry_delay=0.01))
+    assert report.injected['neighbour_corruption'] > 0
+    assert report.bad_values == 0
+
+def test_chaos_all_faults():
+    report = run(run_chaos(200, FAULTS, 0.1, 0, retry_delay=0.01))
+    assert report.bad_values == 0
+    assert report.stuck_pending == 0
+    # Every fault is retried within the cycle or recovered on the next one
+    assert report.failed_cycles <= report.cycles * 0.1
+    assert max(report.recovery_cycles, default=0) <= 2
+    assert report.requests <= report.baseline_requests * 1.2
+
+def test_batches_keep_thermostats_together():
+    async def scenario():
+        gateway, session, client = await connect(2, 12)
+        # Quarantine probes shorten some devices, which moves the batch boundaries
+        values = [value for thermostat in client.thermostats[:12]
+                  for value in (thermostat.poll_values() if thermostat.thermostat_index % 3 else thermostat.values()[:2])]
+        batches = list(client.shard(0).batches(values))
+        assert all(len(batch) <= client.max_values_batch for batch in batches)
+        assert [value for batch in batches for value in batch] == values
+        for thermostat in client.thermostats[:12]:
+            assert len({index for index, batch in enumerate(batches) for value in batch if value.device is thermostat}) == 1
+
+    run(scenario())
+
+def test_quarantine_releases_controller_demand():
+    async def scenario():
+        gateway, session, client = await connect(thermostats=2)
+        for thermostat in client.thermostats:
+            gateway.registers[thermostat.by_name('room_in_demand').id] = 1
+        await client.update_devices(client.thermostats)
+        controller = client.controllers[0]
+        assert controller.rooms_in_demand == 2
+
+        # Both rooms report an invalid setpoint until they are quarantined
+        for thermostat in client.thermostats:
+            gateway.registers[thermostat.by_name('room_setpoint').id] = 0
+        for _ in range(3):
+            await client.update_devices(client.thermostats)
+        assert all(thermostat.quarantined and not thermostat.in_demand for thermostat in client.thermostats)
+        assert controller.rooms_in_demand == 0
+        assert not controller.demand.last_on
+
+    run(scenario())
+
+class OneBadThermostat(GatewaySimulator):
+    """Returns the next thermostat's values for one thermostat only, while bad is set"""
+
+    bad = None
+
+    def handle(self, request, corrupt=False):
+        response = super().handle(request, corrupt)
+        if self.bad is not None and isinstance(response, dict) and 'result' in response:
+            for obj in response['result']['objects']:
+                id = int(obj['id'])
+                if id - self.bad in CORRUPTED_ADDRS:
+                    prop = next(iter(obj['properties']))
+                    obj['properties'][prop]['value'] = self.registers[id + 40]
+        return response
+
+async def update_all(client):
+    for thermostat in client.thermostats:
+        thermostat.last_update = None
+    await client.update_devices(client.thermostats)
+
+def test_rejection_only_counts_against_the_bad_thermostat():
+    async def scenario():
+        gateway = OneBadThermostat(1, 8)
+        client = UponorClient(None, "simulator", SimulatedSession(gateway))
+        await client.rescan()
+        bad = client.thermostats[3]
+        gateway.bad = bad.id_offset
+        for _ in range(QUARANTINE_REJECTED_UPDATES):
+            await update_all(client)
+        assert bad.quarantined
+        assert [thermostat.key for thermostat in client.thermostats if thermostat.quarantined] == [bad.key]
+        # The neighbours in the same responses are still updated
+        assert all(thermostat.rejected_updates == 0 for thermostat in client.thermostats if thermostat is not bad)
+        assert gateway.mismatches(client) == 0
+
+    run(scenario())
+
+def test_rejected_probe_does_not_release_the_thermostat():
+    async def scenario():
+        gateway = OneBadThermostat(1, 8)
+        client = UponorClient(None, "simulator", SimulatedSession(gateway))
+        await client.rescan()
+        bad = client.thermostats[3]
+        gateway.bad = bad.id_offset
+        for _ in range(QUARANTINE_REJECTED_UPDATES):
+            await update_all(client)
+        assert bad.quarantined
+
+        # Probes keep being rejected, the stored values are still valid
+        for _ in range(3):
+            await update_all(client)
+            assert bad.quarantined and bad.is_valid()
+
+        # The first accepted probe releases it, with a clean count
+        gateway.bad = None
+        await update_all(client)
+        assert not bad.quarantined
+        assert bad.rejected_updates == 0
+
+    run(scenario())